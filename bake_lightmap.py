@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import modules.lightcalc
+
+def bake(map_name, workers, shadows, output, renderer, tile_size):
+    timings = []
+    map_path = os.path.join(sys.path[0], 'server', 'maps', map_name)
+    
+    #load
+    phase_start = time.time()
+    with open(os.path.join(map_path, 'list.json'), 'r') as file:
+        map_data = json.load(file)
+    
+    with open(os.path.join(map_path, map_data['layout']), 'r') as file:
+        layout_data = json.load(file)
+    
+    materials = {}
+    for mat in os.listdir(os.path.join(map_path, 'materials')):
+        with open(os.path.join(map_path, 'materials', mat), 'r') as file:
+            materials[mat] = json.load(file)
+    
+    light_sources = [panel for panel in layout_data['geometry'] if materials[panel['material']]['light']['emit'] > 0]
+    blocking_panels = [panel for panel in layout_data['geometry'] if materials[panel['material']]['light']['block'] > 0]
+    timings.append(['load', time.time() - phase_start])
+    
+    #compute
+    phase_start = time.time()
+    scheduler = modules.lightcalc.TileScheduler(map_data, materials, light_sources, blocking_panels, shadows, workers, renderer, tile_size)
+    print('Baking {} ({}x{}, {} lights, {} blocking panels) as {} tiles across {} processes'.format(map_name, *map_data['geometry'], len(light_sources), len(blocking_panels), len(scheduler.tiles), scheduler.workers))
+    values = scheduler.run()
+    timings.append(['compute', time.time() - phase_start])
+    
+    #assemble
+    phase_start = time.time()
+    PILImage = __import__('PIL.Image').Image
+    image = PILImage.fromarray(modules.lightcalc.values_to_rgba(values), 'RGBA')
+    timings.append(['assemble', time.time() - phase_start])
+    
+    #save
+    phase_start = time.time()
+    if output is None:
+        map_data['lighting']['map'] = os.path.join('models', 'system', 'lightmap', 'lightmap.png')
+        image.save(os.path.join(map_path, map_data['lighting']['map']))
+        
+        with open(os.path.join(map_path, 'list.json'), 'w') as file:
+            json.dump(map_data, file, sort_keys = True, indent = '\t')
+        
+        with open(os.path.join(map_path, 'models', 'system', 'lightmap', 'dependencies.json'), 'w') as file:
+            json.dump(scheduler.get_record(), file, sort_keys = True)
+    else:
+        image.save(output)
+    timings.append(['save', time.time() - phase_start])
+    
+    for phase, duration in timings:
+        print('{:<10}{:.3f}s'.format(phase, duration))
+    print('{:<10}{:.3f}s'.format('total', sum([duration for phase, duration in timings])))
+    print('{:.0f} pixels per second'.format((map_data['geometry'][0] * map_data['geometry'][1]) / timings[1][1]))
+
+if __name__ == '__main__':
+    config_path = os.path.join(sys.path[0], 'user', 'config.json')
+    if not os.path.isfile(config_path):
+        config_path = os.path.join(sys.path[0], 'user', 'default_config.json')
+    
+    with open(config_path, 'r') as file:
+        user_config = json.load(file)
+    
+    parser = argparse.ArgumentParser(description = 'Bake the lightmap for a map in server/maps without opening the editor')
+    parser.add_argument('map', help = 'name of the map folder in server/maps')
+    parser.add_argument('-w', '--workers', type = int, default = user_config['graphics']['lightcalc threads'], help = 'number of worker processes')
+    parser.add_argument('-s', '--shadows', choices = ['on', 'off'], default = ['off', 'on'][user_config['editor']['lightmap']['render shadows']], help = 'whether to render shadows')
+    parser.add_argument('-o', '--output', default = None, help = 'where to save the lightmap (by default it replaces the map\'s lightmap and updates its config)')
+    parser.add_argument('-r', '--renderer', choices = list(modules.lightcalc.renderers), default = user_config['editor']['lightmap'].get('renderer', 'cells'), help = 'lightmap calculator to use')
+    parser.add_argument('-t', '--tile-size', type = int, default = user_config['editor']['lightmap'].get('tile size', 32), help = 'size of the tiles handed out to workers')
+    args = parser.parse_args()
+    
+    bake(args.map, args.workers, args.shadows == 'on', args.output, args.renderer, args.tile_size)
@@ -0,0 +1,24 @@
+import argparse
+import time
+
+import modules.config
+import modules.netclients #import before networking, as the game does, so that the circular import between them resolves
+import modules.networking
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run a server without a window. Commands are read from stdin and output is written to stdout - start a command with @<number> to send it to a lobby console, or type @list to see them')
+    parser.add_argument('--port', type = int, default = None, help = 'port to listen on (default is the port in server/config.json)')
+    args = parser.parse_args()
+
+    if args.port is None:
+        args.port = modules.config.service.get('server')['network']['port']
+
+    server = modules.networking.Server(args.port, headless = True)
+
+    try:
+        while server.serverdata.running:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        server.quit()
+
+    server.log.flush()
@@ -0,0 +1,137 @@
+import multiprocessing as mp
+import urllib.request
+import argparse
+import time
+import os
+
+import numpy as np
+
+import modules.config
+import modules.netclients #import before networking, as the game does, so that the circular import between them resolves
+import modules.bots
+
+def percentiles(values, scale = 1):
+    'Format the 50th, 90th and 99th percentiles and the maximum of a list of values'
+    if len(values) == 0:
+        return '{:>9} {:>9} {:>9} {:>9}'.format('-', '-', '-', '-')
+    values = np.array(values) * scale
+    return '{:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(*np.percentile(values, [50, 90, 99]), np.max(values))
+
+def read_metrics(url):
+    'Get the server\'s metrics as {name: value}, adding together the values of metrics that only differ by labels'
+    with urllib.request.urlopen(url, timeout = 5) as response:
+        text = response.read().decode()
+    
+    output = {}
+    for line in text.split('\n'):
+        if line != '' and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            if '{' in name:
+                name, labels = name.split('{', 1)
+                if name.endswith('_bucket'):
+                    continue
+                if 'direction="in"' in labels:
+                    name += '_in'
+                elif 'direction="out"' in labels:
+                    name += '_out'
+            output[name] = output.get(name, 0) + float(value)
+    return output
+
+def run(args):
+    bot_args = {'lobby': args.lobby,
+                'position_rate': args.position_rate,
+                'item_rate': args.item_rate,
+                'ping_rate': args.ping_rate}
+    
+    #share the bots out between the processes
+    processes = []
+    pipes = []
+    for i in range(args.processes):
+        num_bots = (args.bots // args.processes) + (1 if i < args.bots % args.processes else 0)
+        if num_bots > 0:
+            pipe, child_pipe = mp.Pipe()
+            process = mp.Process(target = modules.bots.run_bots, args = [args.host, args.port, num_bots, args.duration, child_pipe, args.ramp, bot_args, 'bot{}_'.format(i)], name = 'Bot process {}'.format(i))
+            process.start()
+            processes.append(process)
+            pipes.append(pipe)
+    
+    print('Started {} bot(s) in {} process(es), ramping up over {}s'.format(args.bots, len(processes), args.ramp))
+    
+    #every process starts measuring once its bots are connected
+    time.sleep(args.ramp)
+    metrics_before = None
+    if args.metrics is not None:
+        metrics_before = read_metrics(args.metrics)
+    measure_start = time.time()
+    
+    results = [pipe.recv() for pipe in pipes]
+    measured_time = time.time() - measure_start
+    metrics_after = None
+    if args.metrics is not None:
+        metrics_after = read_metrics(args.metrics)
+    
+    for process in processes:
+        process.join()
+    
+    return results, metrics_before, metrics_after, measured_time
+
+def summarise(args, results, metrics_before, metrics_after, measured_time):
+    counters = {}
+    for result in results:
+        for name, value in result['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    
+    rtts = sum([result['rtts'] for result in results], [])
+    snapshot_latencies = sum([result['snapshot latencies'] for result in results], [])
+    snapshot_intervals = sum([result['snapshot intervals'] for result in results], [])
+    
+    print('\n{} bot(s) connected, {} failed to connect, {} disconnected by the server'.format(counters['connected'], counters['failed'], counters['disconnected']))
+    print('Measured for {}s'.format(args.duration))
+    
+    print('\n{:<25}{:>8} {:>9} {:>9} {:>9} {:>9}'.format('Latency (ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+    print('{:<25}{:>8} {}'.format('round trip', len(rtts), percentiles(rtts, 1000)))
+    print('{:<25}{:>8} {}'.format('snapshot', len(snapshot_latencies), percentiles(snapshot_latencies, 1000)))
+    print('{:<25}{:>8} {}'.format('snapshot interval', len(snapshot_intervals), percentiles(snapshot_intervals, 1000)))
+    
+    num_bots = max(1, counters['connected'])
+    print('\nPer bot: {:.1f} B/s in, {:.1f} B/s out, {:.1f} requests/s in, {:.1f} requests/s out, {:.2f} items used/s'.format(counters['bytes_in'] / (args.duration * num_bots),
+                                                                                                                           counters['bytes_out'] / (args.duration * num_bots),
+                                                                                                                           counters['requests_in'] / (args.duration * num_bots),
+                                                                                                                           counters['requests_out'] / (args.duration * num_bots),
+                                                                                                                           counters['items_used'] / (args.duration * num_bots)))
+    
+    if metrics_before is not None:
+        def delta(name):
+            return metrics_after.get(name, 0) - metrics_before.get(name, 0)
+        
+        print('\nServer (from {}, over {:.1f}s)'.format(args.metrics, measured_time))
+        
+        cpu_time = delta('process_cpu_seconds')
+        print('CPU: {:.1f}% of a core, {:.2f}ms per bot per second'.format(100 * cpu_time / measured_time, 1000 * cpu_time / (measured_time * num_bots)))
+        
+        num_ticks = delta('lobby_tick_seconds_count')
+        if num_ticks > 0:
+            print('Ticks: {:.1f}/s, mean {:.3f}ms, {} overran the tick interval'.format(num_ticks / measured_time, 1000 * delta('lobby_tick_seconds_sum') / num_ticks, int(delta('lobby_tick_overruns_total'))))
+        
+        print('Network: {:.1f} B/s in, {:.1f} B/s out per bot'.format(delta('network_bytes_total_in') / (measured_time * num_bots), delta('network_bytes_total_out') / (measured_time * num_bots)))
+        print('Clients connected: {}, items in lobbies: {}'.format(int(metrics_after.get('server_clients', 0)), int(metrics_after.get('lobby_items', 0))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load test a running server with bot clients. Start the server first (e.g. with dedicated_server.py)')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address of the server')
+    parser.add_argument('--port', type = int, default = None, help = 'port of the server (default is the port in server/config.json)')
+    parser.add_argument('--bots', type = int, default = 100, help = 'number of bots to connect')
+    parser.add_argument('--processes', type = int, default = os.cpu_count(), help = 'number of processes to run the bots in')
+    parser.add_argument('--duration', type = float, default = 60, help = 'seconds to measure for, after every bot has connected')
+    parser.add_argument('--ramp', type = float, default = 10, help = 'seconds to spread the connections over')
+    parser.add_argument('--lobby', type = int, default = 0, help = 'index of the lobby for the bots to join')
+    parser.add_argument('--position-rate', type = float, default = 20, help = 'position updates per second per bot (the game client sends 20)')
+    parser.add_argument('--item-rate', type = float, default = 1, help = 'average item uses per second per bot')
+    parser.add_argument('--ping-rate', type = float, default = 2, help = 'round trip time measurements per second per bot')
+    parser.add_argument('--metrics', default = None, help = 'URL of the server\'s metrics endpoint (e.g. http://127.0.0.1:9321/metrics) to report server CPU, tick times and bandwidth')
+    args = parser.parse_args()
+    
+    if args.port is None:
+        args.port = modules.config.service.get('server')['network']['port']
+    
+    summarise(args, *run(args))
@@ -7,6 +7,10 @@ import threading
 import time
 import random
 import math
+import heapq
+import traceback
+
+import modules.config
 
 class CanvasController:
     def __init__(self, canvas, game = None, layers = None, get_pil = False):
@@ -23,6 +27,36 @@ class CanvasController:
         
         self.global_time = 0
         
+        class batch: #pending canvas changes that are applied together once per frame
+            enabled = False
+            delay = 0
+            pending = {}
+            lock = threading.Lock()
+            
+            requested = 0 #number of calls asked for since the stats were last updated
+            made = 0 #number of calls actually made to tk since the stats were last updated
+            window_start = 0
+            saved_per_second = 0
+        self.batch = batch
+        
+        class camera: #the part of the world that is being shown on the canvas
+            x = 0 #world coordinates of the top left of the view
+            y = 0
+            width = None #none means use the size of the canvas
+            height = None
+            margin = 0 #extra distance around the view where objects are still drawn
+            
+            models = [] #world space models that must be moved when the camera moves
+            tiles = [] #large static images that are only given canvas objects when they are in view
+        self.camera = camera
+        
+        class animations: #one clock for every animated model - a heap of the times that each model's next frame is due
+            heap = []
+            counter = 0 #breaks ties in the heap so that models never have to be compared
+            condition = threading.Condition()
+            running = False
+        self.animations = animations
+        
         class pillow:
             image = None
             image_chops = None
@@ -125,6 +159,11 @@ class CanvasController:
                 if self.layers[a][b]['object'] == obj:
                     to_remove.append([a, b])
         
+        if self.batch.enabled:
+            with self.batch.lock:
+                if obj in self.batch.pending:
+                    self.batch.pending.pop(obj)
+        
         self.canvas.delete(obj)
         
         to_remove.reverse()
@@ -133,17 +172,213 @@ class CanvasController:
         
     def coords(self, obj, *coords):
         'Set the coordinates of something on the canvas'
-        self.canvas.coords(obj, *coords)
+        if self.batch.enabled:
+            with self.batch.lock:
+                if obj in self.batch.pending:
+                    self.batch.pending[obj]['coords'] = coords
+                else:
+                    self.batch.pending[obj] = {'coords': coords, 'config': {}}
+                self.batch.requested += 1
+        else:
+            self.canvas.coords(obj, *coords)
     
     def itemconfigure(self, obj, **args):
         'Configure an item on the canvas'
-        self.canvas.itemconfigure(obj, **args)
+        if self.batch.enabled:
+            with self.batch.lock:
+                if obj in self.batch.pending:
+                    self.batch.pending[obj]['config'].update(args)
+                else:
+                    self.batch.pending[obj] = {'coords': None, 'config': args}
+                self.batch.requested += 1
+        else:
+            self.canvas.itemconfigure(obj, **args)
+    
+    def start_batching(self, delay = 1 / 60):
+        'Collect calls to coords and itemconfigure and apply them once every delay seconds on the tk thread'
+        self.batch.delay = delay
+        self.batch.window_start = time.time()
+        
+        if not self.batch.enabled:
+            self.batch.enabled = True
+            self.canvas.after(int(self.batch.delay * 1000), self._batch_flushd)
+    
+    def stop_batching(self):
+        self.batch.enabled = False
+        self.flush_batch()
+    
+    def flush_batch(self):
+        'Apply all pending changes to the canvas. Should be called from the tk thread'
+        with self.batch.lock:
+            pending = self.batch.pending
+            self.batch.pending = {}
+        
+        for obj in pending:
+            if pending[obj]['coords'] is not None:
+                self.canvas.coords(obj, *pending[obj]['coords'])
+                self.batch.made += 1
+            
+            if len(pending[obj]['config']) > 0:
+                self.canvas.itemconfigure(obj, **pending[obj]['config'])
+                self.batch.made += 1
+        
+        elapsed = time.time() - self.batch.window_start
+        if elapsed >= 1:
+            self.batch.saved_per_second = (self.batch.requested - self.batch.made) / elapsed
+            self.batch.requested = 0
+            self.batch.made = 0
+            self.batch.window_start = time.time()
+    
+    def _batch_flushd(self):
+        self.flush_batch()
+        
+        if self.batch.enabled:
+            self.canvas.after(int(self.batch.delay * 1000), self._batch_flushd)
     
     def reset_time(self):
         self.set_time(time.time())
     
     def set_time(self, value):
         self.global_time = value
+    
+    def add_animation(self, model, delay):
+        'Schedule a model\'s animation to be advanced after a delay. The model\'s _anim_step method gives the delay until the next frame'
+        with self.animations.condition:
+            heapq.heappush(self.animations.heap, (time.time() + delay, self.animations.counter, model))
+            self.animations.counter += 1
+            self.animations.condition.notify()
+            
+            if not self.animations.running:
+                self.animations.running = True
+                threading.Thread(target = self._animationd, name = 'Animation clock', daemon = True).start()
+    
+    def _animationd(self):
+        while self.animations.running:
+            with self.animations.condition:
+                while len(self.animations.heap) == 0:
+                    self.animations.condition.wait()
+                
+                now = time.time()
+                if self.animations.heap[0][0] > now: #nothing is due yet - wait for the next frame or for an earlier one to be added
+                    self.animations.condition.wait(self.animations.heap[0][0] - now)
+                    continue
+                
+                due = []
+                while len(self.animations.heap) > 0 and self.animations.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.animations.heap))
+            
+            #advance all due models in one pass, outside of the lock so that models can schedule new animations
+            for deadline, counter, model in due:
+                try:
+                    delay = model._anim_step()
+                except Exception:
+                    traceback.print_exc()
+                    delay = None
+                
+                if delay is not None: #model is still animating
+                    next_deadline = deadline + delay
+                    if next_deadline < now: #fallen behind - don't try to catch up
+                        next_deadline = now + delay
+                    
+                    with self.animations.condition:
+                        heapq.heappush(self.animations.heap, (next_deadline, self.animations.counter, model))
+                        self.animations.counter += 1
+    
+    def set_view_size(self, width, height):
+        self.camera.width = width
+        self.camera.height = height
+        self._stream_tiles()
+    
+    def get_view_size(self):
+        'Get the size of the view, or None if it isn\'t known yet (winfo sizes are 1 until the canvas is mapped)'
+        if self.camera.width is None or self.camera.height is None:
+            width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+            if width <= 1 or height <= 1:
+                return None
+            return width, height
+        else:
+            return self.camera.width, self.camera.height
+    
+    def set_camera(self, x, y, force = False):
+        'Move the top left of the view to a point in the world'
+        if force or not (x == self.camera.x and y == self.camera.y):
+            self.camera.x = x
+            self.camera.y = y
+            
+            for model in self.camera.models.copy():
+                model.refresh()
+            
+            self._stream_tiles()
+    
+    def world_to_screen(self, x, y):
+        return x - self.camera.x, y - self.camera.y
+    
+    def screen_to_world(self, x, y):
+        return x + self.camera.x, y + self.camera.y
+    
+    def in_view(self, x0, y0, x1, y1):
+        'Check if a box in world coordinates is at least partially inside the view'
+        view_size = self.get_view_size()
+        if view_size is None: #don't cull anything until the view size is known
+            return True
+        width, height = view_size
+        return x1 >= self.camera.x - self.camera.margin and x0 <= self.camera.x + width + self.camera.margin and y1 >= self.camera.y - self.camera.margin and y0 <= self.camera.y + height + self.camera.margin
+    
+    def register_model(self, model):
+        self.camera.models.append(model)
+    
+    def unregister_model(self, model):
+        if model in self.camera.models:
+            self.camera.models.remove(model)
+    
+    def add_tile(self, x, y, image, layer = 0):
+        'Add a PIL image with its top left at a point in the world. It will only be put on the canvas when it is in view. Returns the tile so that its image can be changed later'
+        tile = {'x': x,
+                'y': y,
+                'width': image.size[0],
+                'height': image.size[1],
+                'image': image,
+                'photoimage': None,
+                'object': None,
+                'layer': layer}
+        self.camera.tiles.append(tile)
+        self._stream_tiles()
+        return tile
+    
+    def set_tile_image(self, tile, image):
+        'Change the PIL image shown by a tile. It is only uploaded to the canvas if the tile is in view'
+        tile['image'] = image
+        if tile['object'] is not None:
+            old_photoimage = tile['photoimage']
+            tile['photoimage'] = self.pillow.photoimage(image)
+            self.itemconfigure(tile['object'], image = tile['photoimage'])
+            
+            #tk deletes an image as soon as python stops referencing it, so the tile would be blank until the batch is flushed
+            if self.batch.enabled:
+                with self.batch.lock:
+                    if tile['object'] in self.batch.pending:
+                        self.batch.pending[tile['object']].setdefault('keep alive', []).append(old_photoimage)
+    
+    def clear_tiles(self):
+        for tile in self.camera.tiles:
+            if tile['object'] is not None:
+                self.delete(tile['object'])
+        self.camera.tiles = []
+    
+    def _stream_tiles(self):
+        'Make canvas objects for tiles that have come into view and delete the ones for tiles that have left it'
+        for tile in self.camera.tiles.copy():
+            if self.in_view(tile['x'], tile['y'], tile['x'] + tile['width'], tile['y'] + tile['height']):
+                if tile['object'] is None:
+                    tile['photoimage'] = self.pillow.photoimage(tile['image'])
+                    tile['object'] = self.create_image(*self.world_to_screen(tile['x'], tile['y']), image = tile['photoimage'], anchor = tk.NW, layer = tile['layer'])
+                else:
+                    self.coords(tile['object'], *self.world_to_screen(tile['x'], tile['y']))
+            
+            elif tile['object'] is not None:
+                self.delete(tile['object'])
+                tile['object'] = None
+                tile['photoimage'] = None
 
 class Model:
     '''
@@ -153,12 +388,15 @@ class Model:
     mdl_name - name of model in map files
     map_path - path to map files
     layer - string or int for canvas controller
+    render - whether to make canvas objects straight away (see make_canvas_objects)
+    screen_space - whether the coordinates are on the screen (e.g. HUD overlays) instead of in the world, in which case the model ignores the camera
     '''
-    def __init__(self, canvas_controller, mdl_name, map_path, layer, autoplay_anims = True):
+    def __init__(self, canvas_controller, mdl_name, map_path, layer, autoplay_anims = True, render = True, screen_space = False):
         self.mdl_name = mdl_name
         self.map_path = map_path
         self.canvas_controller = canvas_controller
         self.layer = layer
+        self.screen_space = screen_space
         
         ## make data structures
         class attributes:
@@ -176,6 +414,8 @@ class Model:
             interps_per_second = 0
             render_quality = 0 #0-3 - render quality as defined in the user's config
             uses_PIL = False
+            swap_images = False #use one canvas object per layer and swap its image instead of moving pre-made objects
+            rendered = True #whether or not canvas objects have been made for this model
             force_grid = None #none means don't force, boolean will force to that value
             
             class anim_controller:
@@ -187,6 +427,7 @@ class Model:
                 
                 frame = 0
                 run_loop = False
+                resync_pending = False #the frame after a one time animation is waiting to be shown
             
             class snap:
                 x = 1
@@ -208,14 +449,9 @@ class Model:
         
         ## load data into structures
         #load configs
-        with open(os.path.join(self.map_path, 'models', self.mdl_name, 'list.json'), 'r') as file:
-            self.cfgs.model = json.load(file)
-        
-        with open(os.path.join(sys.path[0], 'user', 'config.json'), 'r') as file:
-            self.cfgs.user = json.load(file)
-        
-        with open(os.path.join(self.map_path, 'list.json'), 'r') as file:
-            self.cfgs.map = json.load(file)
+        self.cfgs.model = modules.config.service.get_file(os.path.join(self.map_path, 'models', self.mdl_name, 'list.json'))
+        self.cfgs.user = modules.config.service.get('user')
+        self.cfgs.map = modules.config.service.get_file(os.path.join(self.map_path, 'list.json'))
         
         self.pillow = self.canvas_controller.pillow
         
@@ -225,6 +461,8 @@ class Model:
         self.attributes.uses_PIL = self.cfgs.user['graphics']['PILrender']
         self.attributes.render_quality = self.cfgs.user['graphics']['model quality']
         self.attributes.interps_per_second = self.cfgs.user['network']['interpolations per second']
+        self.attributes.swap_images = self.cfgs.user['graphics'].get('model image swapping', False)
+        self.attributes.rendered = render
         
         self.attributes.snap.x = self.cfgs.map['grid']['mult']['x']
         self.attributes.snap.y = self.cfgs.map['grid']['mult']['y']
@@ -243,6 +481,9 @@ class Model:
         if autoplay_anims:
             self.start_anims()
         
+        if not self.screen_space:
+            self.canvas_controller.register_model(self)
+        
         ## call set
         self.set(force = True)
     
@@ -318,9 +559,9 @@ class Model:
                 fields_changed.append('frame')
         
         #check if only the positions were changed
-        if len(fields_changed) > 0: #make sure at least one field was changed
-            if False in [key in ['x', 'y'] for key in fields_changed]:
-                #move currently onscreen objects offscreen
+        if len(fields_changed) > 0 and self.attributes.rendered: #make sure at least one field was changed
+            if False in [key in ['x', 'y'] for key in fields_changed] and not (self.attributes.swap_images and prev_image_set == self.attributes.profile):
+                #move currently onscreen objects offscreen (not needed when the same layer objects just have their images swapped)
                 self.attributes.profiles[prev_image_set].set_offscreen(prev_frame, prev_rotation, prev_transparency)
                     
             #move currently offscreen objects onscreen
@@ -329,40 +570,69 @@ class Model:
     def get_object(self, profile, frame, layer, rotation, transparency):
         return self.attributes.profiles[profile].get_obj(frame, layer, rotation, transparency)
     
+    def make_canvas_objects(self):
+        'Make the canvas objects for a model that was created with render = False'
+        if not self.attributes.rendered:
+            self.attributes.rendered = True
+            
+            for profile_name in self.attributes.profiles:
+                self.attributes.profiles[profile_name].make_canvobjs()
+            
+            self.set(force = True)
+    
+    def refresh(self):
+        'Redraw the model in place (e.g. after the camera has moved)'
+        if self.attributes.rendered:
+            self.attributes.profiles[self.attributes.profile].setpos(self.attributes.pos.x, self.attributes.pos.y, self.attributes.anim_controller.frame, self.attributes.rotation, self.attributes.transparency)
+    
+    def bake_onto(self, image):
+        'Draw the model in its current state onto a PIL image'
+        self.attributes.profiles[self.attributes.profile].bake_onto(image, self.attributes.pos.x, self.attributes.pos.y, self.attributes.anim_controller.frame, self.attributes.rotation, self.attributes.transparency)
+    
     def destroy(self):
-        current_profile = self.attributes.profiles[self.attributes.profile]
-        current_profile.set_offscreen(self.attributes.anim_controller.frame, self.attributes.rotation, self.attributes.transparency)
+        if self.attributes.rendered:
+            current_profile = self.attributes.profiles[self.attributes.profile]
+            current_profile.set_offscreen(self.attributes.anim_controller.frame, self.attributes.rotation, self.attributes.transparency)
         
         for profile_name in self.attributes.profiles:
             self.attributes.profiles[profile_name].destroy()
         
+        self.canvas_controller.unregister_model(self)
+        
         self.attributes.anim_controller.run_loop = False
         self.attributes.running = False
     
-    def _anim_player(self):
-        if self.attributes.profiles[self.attributes.profile].animation.sync:
-            time.sleep((self.attributes.profiles[self.attributes.profile].animation.delay * self.attributes.profiles[self.attributes.profile].animation.frames) - ((time.time() - self.canvas_controller.global_time) % (self.attributes.profiles[self.attributes.profile].animation.delay * self.attributes.profiles[self.attributes.profile].animation.frames)))
+    def _anim_step(self):
+        'Advance the animation by one step. Called by the canvas controller\'s animation clock - returns the delay until the next step, or None to stop'
+        if not self.attributes.anim_controller.run_loop:
+            return None
         
-        while self.attributes.anim_controller.run_loop:
-            time.sleep(self.attributes.profiles[self.attributes.profile].animation.delay + random.choice([0, self.attributes.profiles[self.attributes.profile].animation.variation, 0 - self.attributes.profiles[self.attributes.profile].animation.variation]))
+        if self.attributes.anim_controller.resync_pending:
+            self.attributes.anim_controller.resync_pending = False
             
-            if self.attributes.anim_controller.playing_onetime and self.attributes.profiles[self.attributes.profile].animation.frames - 1 == self.attributes.anim_controller.frame: #resynchronise animations
-                old_anim_delay = self.attributes.profiles[self.attributes.profile].animation.delay
-                old_anim_length = self.attributes.profiles[self.attributes.profile].animation.frames
-                
-                self.set(image_set = self.attributes.anim_controller.revert_to, frame = 0)
-                
-                new_elapsed = time.time() - self.attributes.anim_controller.onetime_start
-                frames_elapsed = new_elapsed / self.attributes.profiles[self.attributes.profile].animation.delay
-                
-                self.set(frame = math.ceil(frames_elapsed) % self.attributes.profiles[self.attributes.profile].animation.frames)
-                
-                time.sleep((self.attributes.profiles[self.attributes.profile].animation.delay - (time.time() - self.attributes.anim_controller.onetime_start - (old_anim_delay * old_anim_length))) % self.attributes.profiles[self.attributes.profile].animation.delay)
-                
-                self.attributes.anim_controller.playing_onetime = False
-                self.attributes.anim_controller.revert_to = None
-                
-            self.increment(frame = 1)
+        elif self.attributes.anim_controller.playing_onetime and self.attributes.profiles[self.attributes.profile].animation.frames - 1 == self.attributes.anim_controller.frame: #resynchronise animations
+            old_anim_delay = self.attributes.profiles[self.attributes.profile].animation.delay
+            old_anim_length = self.attributes.profiles[self.attributes.profile].animation.frames
+            
+            self.set(image_set = self.attributes.anim_controller.revert_to, frame = 0)
+            
+            new_elapsed = time.time() - self.attributes.anim_controller.onetime_start
+            frames_elapsed = new_elapsed / self.attributes.profiles[self.attributes.profile].animation.delay
+            
+            self.set(frame = math.ceil(frames_elapsed) % self.attributes.profiles[self.attributes.profile].animation.frames)
+            
+            self.attributes.anim_controller.playing_onetime = False
+            self.attributes.anim_controller.revert_to = None
+            
+            #show the next frame once the reverted animation has caught up
+            self.attributes.anim_controller.resync_pending = True
+            return (self.attributes.profiles[self.attributes.profile].animation.delay - (time.time() - self.attributes.anim_controller.onetime_start - (old_anim_delay * old_anim_length))) % self.attributes.profiles[self.attributes.profile].animation.delay
+        
+        self.increment(frame = 1)
+        return self._anim_delay()
+    
+    def _anim_delay(self):
+        return self.attributes.profiles[self.attributes.profile].animation.delay + random.choice([0, self.attributes.profiles[self.attributes.profile].animation.variation, 0 - self.attributes.profiles[self.attributes.profile].animation.variation])
     
     def snap_coords(self, x, y):
         x /= self.attributes.snap.x
@@ -400,7 +670,13 @@ class Model:
     
     def start_anims(self):
         if self.attributes.anim_controller.run_loop:
-            threading.Thread(target = self._anim_player, name = 'Model animation player', daemon = True).start()
+            delay = self._anim_delay()
+            
+            if self.attributes.profiles[self.attributes.profile].animation.sync: #wait until the start of the next cycle of the global clock
+                cycle_length = self.attributes.profiles[self.attributes.profile].animation.delay * self.attributes.profiles[self.attributes.profile].animation.frames
+                delay += cycle_length - ((time.time() - self.canvas_controller.global_time) % cycle_length)
+            
+            self.canvas_controller.add_animation(self, delay)
     
     def compare_profiles(self, prof0, prof1):
         """Checks if profile 0 takes precedence over profile 1"""
@@ -453,6 +729,16 @@ class MdlProfile:
         self.transformed_imgs = []
         self.canvobjs = []
         
+        self.rotation_values = []
+        self.transparency_values = []
+        
+        self.swap_images = False
+        self.layerobjs = [] #one canvas object per layer when swapping images
+        self.layerimgs = [] #image currently shown by each layer object
+        
+        self.extent = 0 #furthest distance from the model's position that a texture can reach (used for culling)
+        self.culled = False #whether the model has been moved offscreen because it is outside the view
+        
         if data is not None:
             self.load(data)
     
@@ -472,6 +758,7 @@ class MdlProfile:
         self.use_grid = self._cfg['use grid']
         self.layers = self._cfg['layers']
         self.uses_pil = self.model.attributes.uses_PIL
+        self.swap_images = self.model.attributes.swap_images
         
         self.animation.frames = self._cfg['animation']['frames']
         self.animation.delay = self._cfg['animation']['delay']
@@ -479,15 +766,17 @@ class MdlProfile:
         self.animation.sync = self._cfg['animation']['sync']
         
         if not self.uses_pil and 'no PIL textures' in self._cfg:
-            self._cfg['textures'] = self._cfg['no PIL textures']
+            textures = self._cfg['no PIL textures']
+        else:
+            textures = self._cfg['textures']
         
         #load textures
         ##find the names of the textures
         img_names = []
-        if type(self._cfg['textures']) == str:
-            img_names = [[os.path.join(frame, name) for name in os.listdir(os.path.join(self.model.map_path, 'models', self.model.mdl_name, frame)) if os.path.isfile(os.path.join(self.model.map_path, 'models', self.model.mdl_name, frame, name))] for frame in os.listdir(os.path.join(self.model.map_path, 'models', self.model.mdl_name, self._cfg['textures']))] #unpack a two-level tree of animations then layers
+        if type(textures) == str:
+            img_names = [[os.path.join(frame, name) for name in os.listdir(os.path.join(self.model.map_path, 'models', self.model.mdl_name, frame)) if os.path.isfile(os.path.join(self.model.map_path, 'models', self.model.mdl_name, frame, name))] for frame in os.listdir(os.path.join(self.model.map_path, 'models', self.model.mdl_name, textures))] #unpack a two-level tree of animations then layers
         else:
-            for frame in self._cfg['textures']:
+            for frame in textures:
                 if type(frame) == str:
                     if frame.endswith('.gif'):
                         img_names.append(frame)
@@ -530,74 +819,129 @@ class MdlProfile:
                             current_slot.append(tk.PhotoImage(file = os.path.join(self.model.map_path, 'models', self.model.mdl_name, name)))
                 self.imgs.append(current_slot)
         
+        ##find how far the textures reach from the centre of the model
+        for frame in self.imgs:
+            for layer in frame:
+                if self.uses_pil:
+                    size = layer.size
+                else:
+                    size = layer.width(), layer.height()
+                
+                self.extent = max(self.extent, max(size) / 2)
+        self.extent += max(abs(self.offset.x), abs(self.offset.y)) * self.num_existing_layers
+        
         ##apply operations to textures
         if self.uses_pil:
-            rotation_values = [(value / (self.rotations[self.model.attributes.render_quality] / 360)) % 360 for value in range(1, self.rotations[self.model.attributes.render_quality] + 1, 1)]
-            transparency_values = [value / (self.transparencies[self.model.attributes.render_quality] / 256) - 1 for value in range(1, self.transparencies[self.model.attributes.render_quality] + 1, 1)]
+            self.rotation_values = [(value / (self.rotations[self.model.attributes.render_quality] / 360)) % 360 for value in range(1, self.rotations[self.model.attributes.render_quality] + 1, 1)]
+            self.transparency_values = [value / (self.transparencies[self.model.attributes.render_quality] / 256) - 1 for value in range(1, self.transparencies[self.model.attributes.render_quality] + 1, 1)]
             
-            if self.transparencies[self.model.attributes.render_quality] > 1 and 0 not in transparency_values:
-                transparency_values = [0] + [(value / ((self.transparencies[self.model.attributes.render_quality] - 1) / 360)) % 360 for value in range(1, self.transparencies[self.model.attributes.render_quality], 1)]
+            if self.transparencies[self.model.attributes.render_quality] > 1 and 0 not in self.transparency_values:
+                self.transparency_values = [0] + [(value / ((self.transparencies[self.model.attributes.render_quality] - 1) / 360)) % 360 for value in range(1, self.transparencies[self.model.attributes.render_quality], 1)]
             
         else:
-            rotation_values = [0]
-            transparency_values = [255]
+            self.rotation_values = [0]
+            self.transparency_values = [255]
         
         for frame in self.imgs:
             this_frame = []
             for layer in frame:
                 this_layer = []
-                for rotation in rotation_values:
+                for rotation in self.rotation_values:
                     this_rotation = []
-                    for transparency in transparency_values:
+                    for transparency in self.transparency_values:
                         this_rotation.append(self.apply_to(layer, rotation, transparency))
                     this_layer.append(this_rotation)
                 this_frame.append(this_layer)
             self.transformed_imgs.append(this_frame)
         
-        #make canvas objects
-        for frame in self.transformed_imgs:
-            new_layers = []
-            for layer in frame:
-                new_rotations = []
-                for rotation in layer:
-                    new_transparencies = []
-                    for image_ in rotation:
-                        new_transparencies.append(self.model.canvas_controller.create_image(self.offscreen.x, self.offscreen.y, image = image_, layer = self.model.layer))
-                    new_rotations.append(new_transparencies)
-                new_layers.append(new_rotations)
-            self.canvobjs.append(new_layers)
-        
-        if len(self.canvobjs) > 1:
+        if self.model.attributes.rendered:
+            self.make_canvobjs()
+        
+        if len(self.transformed_imgs) > 1:
             self.model.attributes.anim_controller.run_loop = True
     
+    def make_canvobjs(self):
+        if self.swap_images: #one object per layer - images are swapped onto it as the state changes
+            for image_ in [layer[0][0] for layer in self.transformed_imgs[0]]:
+                self.layerobjs.append(self.model.canvas_controller.create_image(self.offscreen.x, self.offscreen.y, image = image_, layer = self.model.layer))
+                self.layerimgs.append(image_)
+        
+        else:
+            for frame in self.transformed_imgs:
+                new_layers = []
+                for layer in frame:
+                    new_rotations = []
+                    for rotation in layer:
+                        new_transparencies = []
+                        for image_ in rotation:
+                            new_transparencies.append(self.model.canvas_controller.create_image(self.offscreen.x, self.offscreen.y, image = image_, layer = self.model.layer))
+                        new_rotations.append(new_transparencies)
+                    new_layers.append(new_rotations)
+                self.canvobjs.append(new_layers)
+    
     def apply_to(self, image, rotation, transparency):
         if self.uses_pil:
-            if not rotation == 0:
-                image = image.rotate((0 - rotation) % 360)
-            
-            if not transparency == 255:
-                try:
-                    image = self.model.pillow.image_chops.multiply(image, self.model.pillow.image.new('RGBA', image.size, color = (255, 255, 255, int(transparency))))
-                except ValueError:
-                    raise ValueError('Model texture doesn\'t have an alpha channel - make sure it uses 32 bit colour')
-                
-            return self.model.pillow.photoimage(image)
+            return self.model.pillow.photoimage(self.transform(image, rotation, transparency))
         else:
             return image
     
+    def transform(self, image, rotation, transparency):
+        'Rotate and fade a PIL image'
+        if not rotation == 0:
+            image = image.rotate((0 - rotation) % 360)
+        
+        if not transparency == 255:
+            try:
+                image = self.model.pillow.image_chops.multiply(image, self.model.pillow.image.new('RGBA', image.size, color = (255, 255, 255, int(transparency))))
+            except ValueError:
+                raise ValueError('Model texture doesn\'t have an alpha channel - make sure it uses 32 bit colour')
+        
+        return image
+    
+    def bake_onto(self, image, x, y, frame, rotation, transparency):
+        'Composite the layers of a frame onto a PIL image. Only works when PIL is being used'
+        rot, transp = self.get_variant(rotation, transparency)
+        
+        for layer in range(len(self.imgs[frame])):
+            texture = self.transform(self.imgs[frame][layer], self.rotation_values[rot], self.transparency_values[transp]).convert('RGBA')
+            
+            centre_x, centre_y = self.get_world_coords(x, y, layer)
+            left = round(centre_x) - int(texture.size[0] / 2)
+            top = round(centre_y) - int(texture.size[1] / 2)
+            
+            #alpha_composite can't take negative destinations, so trim off anything above or to the left of the image
+            texture = texture.crop((max(0, 0 - left), max(0, 0 - top), texture.size[0], texture.size[1]))
+            if texture.size[0] > 0 and texture.size[1] > 0:
+                image.alpha_composite(texture, (max(0, left), max(0, top)))
+    
     def get_obj(self, frame, layer, rotation, transparency):
+        if self.swap_images:
+            return self.layerobjs[layer]
+        else:
+            rot, transp = self.get_variant(rotation, transparency)
+            return self.canvobjs[frame][layer][rot][transp]
+    
+    def get_image(self, frame, layer, rotation, transparency):
+        rot, transp = self.get_variant(rotation, transparency)
+        return self.transformed_imgs[frame][layer][rot][transp]
+    
+    def get_variant(self, rotation, transparency):
+        'Get the rotation and transparency indexes of the image to use'
         if self.uses_pil:
             rot = int((self.squash_rotation(rotation) / 360) * self.rotations[self.model.attributes.render_quality])
             transp = int(self.squash_transparency(transparency) / (256 / self.transparencies[self.model.attributes.render_quality]))
-            return self.canvobjs[frame][layer][rot][transp]
+            return rot, transp
         else:
-            return self.canvobjs[frame][layer][0][0]
+            return 0, 0
     
     def get_offset(self, layer):
-        real_index = int(layer * (self.num_existing_layers / len(self.canvobjs[0])))
+        real_index = int(layer * (self.num_existing_layers / len(self.transformed_imgs[0])))
         return self.offset.x * real_index, self.offset.y * real_index
     
     def destroy(self):
+        for canvobj in self.layerobjs:
+            self.model.canvas_controller.delete(canvobj)
+        
         for frame in self.canvobjs:
             for layer in frame:
                 for rotation in layer:
@@ -614,14 +958,49 @@ class MdlProfile:
         return func_clamp(value / division) * division
     
     def setpos(self, x, y, frame, rotation, transparency):
-        for layer in range(len(self.canvobjs[frame])):
-            if x == self.offscreen.x and y == self.offscreen.y:
-                self.model.canvas_controller.coords(self.get_obj(frame, layer, rotation, transparency), x, y)
+        is_offscreen = x == self.offscreen.x and y == self.offscreen.y
+        
+        if not (is_offscreen or self.model.screen_space):
+            if self.model.canvas_controller.in_view(x - self.extent, y - self.extent, x + self.extent, y + self.extent):
+                self.culled = False
+            
+            elif self.culled: #already offscreen
+                return None
+            
             else:
-                if self.use_grid:
-                    self.model.canvas_controller.coords(self.get_obj(frame, layer, rotation, transparency), *self.model.snap_coords(x + self.get_offset(layer)[0], y + self.get_offset(layer)[1]))
-                else:
-                    self.model.canvas_controller.coords(self.get_obj(frame, layer, rotation, transparency), x + self.get_offset(layer)[0], y + self.get_offset(layer)[1])
+                self.culled = True
+                is_offscreen = True
+        
+        for layer in range(len(self.transformed_imgs[frame])):
+            obj = self.get_obj(frame, layer, rotation, transparency)
+            
+            if is_offscreen:
+                self.model.canvas_controller.coords(obj, self.offscreen.x, self.offscreen.y)
+            else:
+                if self.swap_images: #only reconfigure the object if the image has actually changed
+                    image_ = self.get_image(frame, layer, rotation, transparency)
+                    if image_ is not self.layerimgs[layer]:
+                        self.model.canvas_controller.itemconfigure(obj, image = image_)
+                        self.layerimgs[layer] = image_
+                
+                self.model.canvas_controller.coords(obj, *self.get_screen_coords(x, y, layer))
+    
+    def get_screen_coords(self, x, y, layer):
+        'Find where a layer is drawn on the canvas for the given model position'
+        x, y = self.get_world_coords(x, y, layer)
+        
+        if self.model.screen_space:
+            return x, y
+        else:
+            return self.model.canvas_controller.world_to_screen(x, y)
+    
+    def get_world_coords(self, x, y, layer):
+        'Find where a layer is drawn in the world for the given model position'
+        if self.use_grid:
+            return self.model.snap_coords(x + self.get_offset(layer)[0], y + self.get_offset(layer)[1])
+        else:
+            return x + self.get_offset(layer)[0], y + self.get_offset(layer)[1]
     
     def set_offscreen(self, frame, rotation, transparency):
-        self.setpos(self.offscreen.x, self.offscreen.y, frame, rotation, transparency)
\ No newline at end of file
+        if not self.culled: #culled profiles already have all of their objects offscreen
+            self.setpos(self.offscreen.x, self.offscreen.y, frame, rotation, transparency)
\ No newline at end of file
@@ -1,3 +1,290 @@
-class Bot:
+import threading
+import random
+import socket
+import json
+import math
+import time
+import os
+import sys
+
+import modules.netclients
+from modules.networking import Request
+
+class BotStats:
+    """
+    Measurements shared by every bot in a process
+    
+    Round trip time is how long the server takes to answer a lobby list request. Snapshot latency is the time between a bot sending a position and any bot in the same process seeing it in a player positions push, so it needs at least two bots per lobby in each process. Snapshot interval is the time between player positions pushes arriving at a bot
+    """
     def __init__(self):
-        pass
\ No newline at end of file
+        self.rtts = []
+        self.snapshot_latencies = []
+        self.snapshot_intervals = []
+        
+        class counters:
+            connected = 0
+            failed = 0
+            disconnected = 0
+            bytes_in = 0
+            bytes_out = 0
+            requests_in = 0
+            requests_out = 0
+            items_used = 0
+        self.counters = counters
+        
+        self._positions_sent = {} #(x, y): time sent
+        self._lock = threading.Lock()
+    
+    def position_sent(self, x, y):
+        with self._lock:
+            self._positions_sent[(x, y)] = time.perf_counter()
+    
+    def positions_received(self, positions):
+        now = time.perf_counter()
+        with self._lock:
+            for position in positions:
+                sent = self._positions_sent.pop((position['x'], position['y']), None)
+                if sent is not None:
+                    self.snapshot_latencies.append(now - sent)
+    
+    def prune(self, max_age = 5):
+        'Forget positions that were overwritten on the server before a push included them'
+        cutoff = time.perf_counter() - max_age
+        with self._lock:
+            self._positions_sent = {key: sent for key, sent in self._positions_sent.items() if sent > cutoff}
+    
+    def increment(self, counter, amount = 1):
+        with self._lock:
+            setattr(self.counters, counter, getattr(self.counters, counter) + amount)
+    
+    def as_dict(self):
+        with self._lock:
+            return {'rtts': list(self.rtts),
+                    'snapshot latencies': list(self.snapshot_latencies),
+                    'snapshot intervals': list(self.snapshot_intervals),
+                    'counters': {name: getattr(self.counters, name) for name in ['connected', 'failed', 'disconnected', 'bytes_in', 'bytes_out', 'requests_in', 'requests_out', 'items_used']}}
+
+
+class Bot(modules.netclients.Client):
+    """
+    Headless client for load testing. Joins a lobby, moves around, uses items and measures latency into a BotStats
+    
+    Rates are per second. Uses the same requests as the game client, so the server can't tell a bot from a player
+    """
+    def __init__(self, host, port, stats, lobby = 0, username = 'bot', position_rate = 20, item_rate = 1, ping_rate = 2):
+        class serverdata:
+            raw = {'address': host, 'port': port}
+        serverdata.host = host #a class body can't assign a name and read the argument of the same name
+        serverdata.port = port
+        self.serverdata = serverdata
+        
+        self.ui = None
+        self._log = None
+        
+        self.stats = stats
+        self.lobby = lobby
+        self.username = username
+        self.rates = {'position': position_rate, 'item': item_rate, 'ping': ping_rate}
+        
+        class state:
+            map_name = None
+            mode = None
+            x = 0
+            y = 0
+            rotation = 0
+            heading = random.uniform(0, 2 * math.pi)
+            inventory = [] #[item, quantity] for each slot
+            unlimited = {} #item: whether the item never runs out
+            last_snapshot = None
+        self.state = state
+        
+        self._ping_times = []
+        self._ping_lock = threading.Lock()
+        
+        self.running = False
+        
+        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connection.connect((self.serverdata.host, self.serverdata.port))
+        
+        self.listener = modules.netclients.SocketListen(self)
+        self.listener.binds.append(self.handle)
+        self.listener.on_traffic = self._record_received
+        self.listener.listen()
+    
+    def send_raw(self, text):
+        data = text.encode()
+        self.connection.send(data)
+        self.stats.increment('bytes_out', len(data))
+        self.stats.increment('requests_out')
+    
+    def _record_received(self, kind, num_bytes, command, subcommand):
+        self.stats.increment('bytes_in', num_bytes)
+        self.stats.increment('requests_in')
+    
+    def start(self):
+        'Join the lobby and start sending requests from a daemon thread'
+        self.running = True
+        self.join_lobby(self.lobby)
+        self.read_var('map')
+        threading.Thread(target = self._behaviourd, name = 'Bot behaviour', daemon = True).start()
+    
+    def stop(self):
+        'Tell the server that the bot is leaving and close the connection'
+        self.running = False
+        try:
+            self.send_raw(Request(command = 'disconnect', arguments = {'clean': True}).as_json())
+        except OSError: #the server has already gone
+            pass
+        
+        #wake the listener up instead of closing the socket under it - it closes the socket when it stops
+        self.listener.running = False
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def handle(self, req):
+        if req.command == 'lobby response' and req.subcommand == 'list':
+            with self._ping_lock:
+                if len(self._ping_times) > 0:
+                    self.stats.rtts.append(time.perf_counter() - self._ping_times.pop(0))
+        
+        elif req.command == 'var update w':
+            if req.subcommand == 'player positions':
+                now = time.perf_counter()
+                if self.state.last_snapshot is not None:
+                    self.stats.snapshot_intervals.append(now - self.state.last_snapshot)
+                self.state.last_snapshot = now
+                self.stats.positions_received(req.arguments['positions'])
+            
+            elif req.subcommand == 'map':
+                map_name = req.arguments.get('map name', req.arguments.get('map'))
+                if map_name != self.state.map_name:
+                    self.state.map_name = map_name
+                    self.state.unlimited = self._load_item_data(map_name)
+                    self.notify_map_load_finished()
+            
+            elif req.subcommand == 'client position':
+                self.state.x = req.arguments.get('x', self.state.x)
+                self.state.y = req.arguments.get('y', self.state.y)
+                self.state.rotation = req.arguments.get('rotation', self.state.rotation)
+        
+        elif req.command == 'var update r' and req.subcommand == 'username':
+            self.write_var('username', self.username)
+        
+        elif req.command == 'set mode':
+            self.state.mode = req.subcommand
+        
+        elif req.command == 'give':
+            for item in req.arguments['items']:
+                self.state.inventory.append([item['item'], item['quantity']])
+        
+        elif req.command == 'clear inventory':
+            self.state.inventory = []
+        
+        elif req.command == 'increment inventory slot':
+            index = req.arguments['index']
+            if index < len(self.state.inventory) and not self.state.unlimited.get(self.state.inventory[index][0], False):
+                self.state.inventory[index][1] += req.arguments['increment']
+        
+        elif req.command == 'disconnect':
+            if self.running:
+                self.stats.increment('disconnected')
+            self.running = False
+    
+    def _load_item_data(self, map_name):
+        'Find out which items are unlimited. Bots run from the same checkout as the server, so the map files are read directly'
+        unlimited = {}
+        path = os.path.join(sys.path[0], 'server', 'maps', map_name, 'items')
+        if os.path.isdir(path):
+            for item_name in os.listdir(path):
+                if item_name.endswith('.json'):
+                    with open(os.path.join(path, item_name), 'r') as file:
+                        unlimited[item_name] = json.load(file).get('unlimited', False)
+        return unlimited
+    
+    def _behaviourd(self):
+        next_send = {name: time.perf_counter() + random.uniform(0, 1 / rate) for name, rate in self.rates.items() if rate > 0}
+        
+        while self.running:
+            name = min(next_send, key = next_send.get)
+            time.sleep(max(0, next_send[name] - time.perf_counter()))
+            if not self.running:
+                break
+            
+            if name == 'position':
+                self._move()
+            elif name == 'item':
+                self._use_random_item()
+            elif name == 'ping':
+                with self._ping_lock:
+                    self._ping_times.append(time.perf_counter())
+                self.list_lobbies()
+            
+            #items are used at random intervals so that bots don't all fire on the same tick
+            if name == 'item':
+                next_send[name] += random.expovariate(self.rates[name])
+            else:
+                next_send[name] += 1 / self.rates[name]
+    
+    def _move(self):
+        if self.state.mode != 'player':
+            return
+        
+        self.state.heading += random.uniform(-0.3, 0.3)
+        self.state.x += math.cos(self.state.heading) * 5 + random.random() #the random part keeps every position unique, so it can be matched up in a snapshot
+        self.state.y += math.sin(self.state.heading) * 5 + random.random()
+        self.state.rotation = math.degrees(self.state.heading) % 360
+        
+        self.stats.position_sent(self.state.x, self.state.y)
+        self.write_var('position', {'x': self.state.x, 'y': self.state.y, 'rotation': self.state.rotation})
+    
+    def _use_random_item(self):
+        if self.state.mode != 'player':
+            return
+        
+        slots = [i for i, (item, quantity) in enumerate(self.state.inventory) if quantity > 0 or self.state.unlimited.get(item, False)]
+        if len(slots) > 0:
+            slot = random.choice(slots)
+            self.use_item(self.state.inventory[slot][0], self.state.rotation, [self.state.x, self.state.y], slot)
+            self.stats.increment('items_used')
+
+
+def run_bots(host, port, num_bots, duration, pipe, ramp_time = 0, bot_args = None, name_prefix = 'bot'):
+    'Run a group of bots in this process for duration seconds (after ramping up), then send a BotStats dictionary down the pipe'
+    if bot_args is None:
+        bot_args = {}
+    
+    stats = BotStats()
+    bots = []
+    
+    #spread out connections - the server only has a small backlog of unaccepted connections
+    for i in range(num_bots):
+        time.sleep(ramp_time / max(1, num_bots))
+        try:
+            bot = Bot(host, port, stats, username = '{}{}'.format(name_prefix, i), **bot_args)
+        except OSError:
+            stats.increment('failed')
+        else:
+            bot.start()
+            bots.append(bot)
+            stats.increment('connected')
+    
+    #only measure once every bot is running
+    with stats._lock:
+        stats.rtts.clear()
+        stats.snapshot_latencies.clear()
+        stats.snapshot_intervals.clear()
+        for counter in ['bytes_in', 'bytes_out', 'requests_in', 'requests_out', 'items_used']:
+            setattr(stats.counters, counter, 0)
+    
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        time.sleep(min(1, max(0, end - time.perf_counter())))
+        stats.prune()
+    
+    result = stats.as_dict()
+    for bot in bots:
+        bot.stop()
+    
+    pipe.send(result)
@@ -0,0 +1,227 @@
+import threading
+import json
+import os
+import sys
+
+number = (int, float)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Optional:
+    'Marks a schema entry that doesn\'t have to be in the file'
+    def __init__(self, schema):
+        self.schema = schema
+
+
+class ConfigView(dict):
+    """
+    Read-only dictionary of config values. Nested dictionaries are also ConfigViews and lists become tuples
+    
+    Use dict(view) or json.loads(json.dumps(view)) to get something that can be changed
+    """
+    def __init__(self, data):
+        super().__init__({key: freeze(value) for key, value in data.items()})
+    
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Config values can\'t be changed - edit the file and call reload instead')
+    
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+    
+    def __reduce__(self):
+        return (ConfigView, (dict(self),))
+    
+    def get_path(self, *path, default = None):
+        'Follow a path of keys through nested views. Returns default if any of them are missing'
+        value = self
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return default
+            value = value[key]
+        return value
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return ConfigView(value)
+    elif isinstance(value, list):
+        return tuple([freeze(item) for item in value])
+    else:
+        return value
+
+
+#schemas - only the keys that are read without a default need to be listed
+schemas = {'user': {'default window state': int,
+                    'editor': dict,
+                    'force close': int,
+                    'graphics': {'PILrender': bool,
+                                 'lightcalc threads': int,
+                                 'model quality': int,
+                                 'resolution': list},
+                    'hud': {'chat': dict,
+                            'killfeed': dict,
+                            'overlays': dict,
+                            'popmsg': dict,
+                            'round timer': dict,
+                            'scoreboard': dict},
+                    'logs': Optional(dict),
+                    'network': {'accurate hit detection': bool,
+                                'default port': int,
+                                'default tickrate': number,
+                                'interpolations per second': number,
+                                'servers': list},
+                    'styling': dict,
+                    'user': {'name': str}},
+           'server': {'logs': Optional(dict),
+                      'messages': {'chat': dict,
+                                   'fullscreen': dict,
+                                   'killfeed': list},
+                      'metrics': Optional(dict),
+                      'network': {'accurate hit detection': bool,
+                                  'port': int,
+                                  'tickrate': number},
+                      'player': {'gamemodes': dict},
+                      'scripts': {'lobby': dict,
+                                  'server': dict},
+                      'trace': Optional(dict)},
+           'keybinds': {'inventory': dict,
+                        'movement': dict,
+                        'window': dict}}
+
+
+def validate(data, schema, path = ''):
+    'Get a list of the ways data doesn\'t match the schema'
+    if isinstance(schema, Optional):
+        schema = schema.schema
+    
+    if isinstance(schema, dict):
+        if not isinstance(data, dict):
+            return ['{} should be a dictionary'.format(path or 'file')]
+        
+        errors = []
+        for key, key_schema in schema.items():
+            if key in data:
+                errors += validate(data[key], key_schema, '{}/{}'.format(path, key))
+            elif not isinstance(key_schema, Optional):
+                errors.append('{}/{} is missing'.format(path, key))
+        return errors
+    
+    elif not isinstance(data, schema):
+        if type(schema) == tuple:
+            names = ' or '.join([item.__name__ for item in schema])
+        else:
+            names = schema.__name__
+        return ['{} should be {}, not {}'.format(path, names, type(data).__name__)]
+    
+    return []
+
+
+class ConfigService:
+    """
+    Loads config files once and shares read-only views of them
+    
+    Call reload after changing a file on disk. Functions bound to a config with bind are called with (name, old view, new view) when a reload changes it
+    
+    Other JSON files (map, model, material and item files) can be loaded by path with get_file. Call forget after changing one of them
+    """
+    files = {'user': ['user', 'config.json'],
+             'server': ['server', 'config.json'],
+             'keybinds': ['user', 'keybinds.json']}
+    
+    def __init__(self, root):
+        self.root = root
+        
+        self._views = {}
+        self._files = {} #absolute path: view
+        self._binds = {}
+        self._lock = threading.RLock()
+    
+    def get(self, name):
+        'Get a read-only view of a config file. The file is only read the first time'
+        view = self._views.get(name)
+        if view is None:
+            with self._lock:
+                if name not in self._views:
+                    self._views[name] = self._load(name)
+                view = self._views[name]
+        return view
+    
+    def get_file(self, path):
+        'Get a read-only view of a JSON file by path. The file is only read the first time'
+        path = os.path.abspath(path)
+        view = self._files.get(path)
+        if view is None:
+            with open(path, 'r') as file:
+                view = ConfigView(json.load(file))
+            
+            with self._lock:
+                view = self._files.setdefault(path, view)
+        return view
+    
+    def forget(self, path = None):
+        'Make get_file read a file (or every file in a directory, or every file if no path is given) again next time'
+        with self._lock:
+            if path is None:
+                self._files.clear()
+            
+            else:
+                path = os.path.abspath(path)
+                for file_path in list(self._files):
+                    if file_path == path or file_path.startswith(path + os.sep):
+                        self._files.pop(file_path)
+    
+    def reload(self, name = None):
+        'Read config files again (all the ones that have been loaded if no name is given) and notify binds of any that changed. Returns the names of the changed configs'
+        with self._lock:
+            if name is None:
+                names = list(self._views)
+            else:
+                names = [name]
+            
+            changed = []
+            for config_name in names:
+                old_view = self._views.get(config_name)
+                new_view = self._load(config_name)
+                self._views[config_name] = new_view
+                
+                if old_view is not None and old_view != new_view:
+                    changed.append([config_name, old_view, new_view])
+        
+        for config_name, old_view, new_view in changed:
+            for func in list(self._binds.get(config_name, [])):
+                func(config_name, old_view, new_view)
+        
+        return [config_name for config_name, old_view, new_view in changed]
+    
+    def bind(self, name, func):
+        with self._lock:
+            if name not in self._binds:
+                self._binds[name] = []
+            self._binds[name].append(func)
+    
+    def unbind(self, name, func):
+        with self._lock:
+            if name in self._binds and func in self._binds[name]:
+                self._binds[name].remove(func)
+    
+    def _load(self, name):
+        path = os.path.join(self.root, *self.files[name])
+        with open(path, 'r') as file:
+            data = json.load(file)
+        
+        errors = validate(data, schemas.get(name, dict))
+        if len(errors) > 0:
+            raise ConfigError('Invalid config {}:\n{}'.format(path, '\n'.join(errors)))
+        
+        return ConfigView(data)
+
+
+service = ConfigService(sys.path[0])
@@ -1,15 +1,26 @@
-import multiprocessing as mp
 import sqlite3 as sql
 import threading
+import queue
 import time
+import bisect
+import collections
+import urllib.request
 import os
 
 
 class DBAccess:
     """
     Flexible SQL database slave
+    
+    Functions named in _write_funcs are fire-and-forget: they return straight away and are committed in batches of up to batch_size, or after batch_window seconds
+    
+    Functions named in _read_funcs run in the calling thread on one of read_connections read-only connections, so they don't wait behind the daemon. They are passed the connection to use as their first argument and only see committed changes
+    
+    _migrations lists the names of the methods that upgrade the database schema, in order. The schema version (PRAGMA user_version) is the number of migrations that have been run
     """
-    def __init__(self, path, log = None):
+    _migrations = []
+    
+    def __init__(self, path, log = None, batch_size = 500, batch_window = 0.5, read_connections = 2):
         self.path = path
         self._log = log
         
@@ -17,44 +28,179 @@ class DBAccess:
         self._running = True
         self._funcs = {'close': self._daemonfuncs_close,
                        'commit': self._daemonfuncs_commit}
+        self._write_funcs = [] #functions that don't return anything, so the caller doesn't need to wait for them
+        self._read_funcs = [] #functions that don't change anything, so they can run on the read connections
+        
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.read_connections = read_connections
+        
+        self._read_pool = queue.Queue() #filled by the daemon once the database has been migrated
+        
+        self._stats = {} #function name: [calls, total time, max time, recent times]
+        self._stats_lock = threading.Lock()
         
         self.is_new = not os.path.isfile(self.path)
         
-        pipe, self._pipe = mp.Pipe()
+        self._queue = queue.Queue()
         
-        threading.Thread(target = self._databased, name = 'Database daemon', args = [pipe], daemon = True).start()
+        threading.Thread(target = self._databased, name = 'Database daemon', daemon = True).start()
     
     def __getattr__(self, item):
-        if item in self._funcs:
+        if item in self._write_funcs:
+            return lambda *args, **kwargs: self._queue.put([None, item, args, kwargs])
+        elif item in self._read_funcs:
+            return lambda *args, **kwargs: self._read_func(item, *args, **kwargs)
+        elif item in self._funcs:
             return lambda *args, **kwargs: self._generic_func(item, *args, **kwargs)
         else:
             raise AttributeError(item)
     
     def _generic_func(self, func_name, *args, **kwargs):
-        master, slave = mp.Pipe()
+        start = time.perf_counter()
+        response = queue.Queue(maxsize = 1)
         
-        self._pipe.send([slave, func_name, args, kwargs])
+        self._queue.put([response, func_name, args, kwargs])
         
-        code, result = master.recv()
+        code, result = response.get()
+        self._record_time(func_name, time.perf_counter() - start)
         
         if code == 0:
             return result
         elif code == 1:
             raise AttributeError(result)
+        elif code == 2:
+            raise result
+    
+    def _read_func(self, func_name, *args, **kwargs):
+        start = time.perf_counter()
+        connection = self._read_pool.get()
+        
+        try:
+            return self._funcs[func_name](connection, *args, **kwargs)
+        
+        except sql.Error as e:
+            self._log_wrapper('Error in {}: {}'.format(func_name, e))
+            raise
+        
+        finally:
+            self._read_pool.put(connection)
+            self._record_time(func_name, time.perf_counter() - start)
+    
+    def _record_time(self, func_name, duration):
+        with self._stats_lock:
+            if func_name not in self._stats:
+                self._stats[func_name] = [0, 0, 0, collections.deque(maxlen = 1000)]
+            
+            stats = self._stats[func_name]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3].append(duration)
+    
+    def get_queue_depth(self):
+        'Number of operations waiting for the daemon'
+        return self._queue.qsize()
     
-    def _databased(self, pipe):
+    def get_stats(self):
+        'Get the number of calls and the mean, 95th percentile and max latency (in seconds) of each function. Reads and queries are timed from the caller\'s side, writes and commits are timed in the daemon'
+        output = {}
+        with self._stats_lock:
+            for func_name, (calls, total, max_time, recent) in self._stats.items():
+                recent = sorted(recent)
+                output[func_name] = {'calls': calls,
+                                     'mean': total / calls,
+                                     'p95': recent[int(len(recent) * 0.95)],
+                                     'max': max_time}
+        return output
+    
+    def format_stats(self):
+        'Get the output of get_stats as lines of text for the console'
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return ['No database operations yet']
+        
+        output = ['Database operations (latency in ms):']
+        for func_name in sorted(stats):
+            output.append('{}: {} call(s), mean {:.2f}, p95 {:.2f}, max {:.2f}'.format(func_name, stats[func_name]['calls'], stats[func_name]['mean'] * 1000, stats[func_name]['p95'] * 1000, stats[func_name]['max'] * 1000))
+        return output
+    
+    def _databased(self):
         self._db_connection = sql.connect(self.path)
+        self._db_connection.execute('PRAGMA journal_mode = WAL')
+        self._migrate()
+        
+        read_uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(self.path)))
+        read_connections = [sql.connect(read_uri, uri = True, check_same_thread = False) for i in range(self.read_connections)]
+        for connection in read_connections:
+            self._read_pool.put(connection)
+        
+        uncommitted = 0 #number of writes since the last commit
+        batch_started = None #when the first uncommitted write was made
         
         while self._running:
-            master_pipe, func_name, args, kwargs = pipe.recv()
+            if batch_started is None:
+                timeout = None
+            else:
+                timeout = max(0, (batch_started + self.batch_window) - time.time())
             
-            if func_name in self._funcs:
-                master_pipe.send((0, self._funcs[func_name](*args, **kwargs)))
+            try:
+                response, func_name, args, kwargs = self._queue.get(timeout = timeout)
+            except queue.Empty:
+                pass
             else:
-                master_pipe.send((1, 'Function "{}" not found'.format(func_name)))
+                if func_name in self._funcs:
+                    start = time.perf_counter()
+                    try:
+                        result = (0, self._funcs[func_name](*args, **kwargs))
+                    except sql.Error as e:
+                        self._log_wrapper('Error in {}: {}'.format(func_name, e))
+                        result = (2, e)
+                    
+                    if response is None:
+                        self._record_time(func_name, time.perf_counter() - start)
+                else:
+                    result = (1, 'Function "{}" not found'.format(func_name))
+                
+                if func_name == 'commit':
+                    uncommitted = 0
+                    batch_started = None
+                
+                elif func_name in self._write_funcs:
+                    uncommitted += 1
+                    if batch_started is None:
+                        batch_started = time.time()
+                
+                elif self._db_connection.in_transaction: #other functions are committed straight away, as before
+                    self._db_connection.commit()
+                    uncommitted = 0
+                    batch_started = None
+                
+                if response is not None:
+                    response.put(result)
             
-            self._db_connection.commit()
+            if uncommitted >= self.batch_size or (batch_started is not None and time.time() >= batch_started + self.batch_window):
+                start = time.perf_counter()
+                self._db_connection.commit()
+                self._record_time('batch commit', time.perf_counter() - start)
+                uncommitted = 0
+                batch_started = None
+        
+        self._db_connection.commit()
         self._db_connection.close()
+        
+        for connection in read_connections:
+            connection.close()
+    
+    def _migrate(self):
+        'Run any migrations that haven\'t been run on this database yet'
+        version = self._db_connection.execute('PRAGMA user_version').fetchone()[0]
+        
+        for i in range(version, len(self._migrations)):
+            getattr(self, self._migrations[i])()
+            self._db_connection.execute('PRAGMA user_version = {}'.format(i + 1))
+            self._db_connection.commit()
+            self._log_wrapper('Migrated database to version {} ({})'.format(i + 1, self._migrations[i]))
     
     def _log_wrapper(self, text):
         'A wrapper for the database log (if it has been specified)'
@@ -71,41 +217,189 @@ class DBAccess:
 
 
 class ServerDatabase(DBAccess):
-    def __init__(self, path, log = None):
+    _migrations = ['_migration_users', '_migration_keyed_users', '_migration_matches']
+    
+    def __init__(self, path, log = None, leaderboard_size = 100, elo_k_factor = 32):
         super().__init__(path, log)
         
+        self.elo_k_factor = elo_k_factor
+        
+        #leaderboard cache - the top rows of the leaderboard, highest elo first. Kept up to date by the daemon so that reading it doesn't touch the database
+        self.leaderboard_size = leaderboard_size #minimum number of rows to load when the cache doesn't have enough
+        self._leaderboard = [] #(username, elo, wins, losses)
+        self._leaderboard_keys = [] #negated elo of each row, for bisect
+        self._leaderboard_rows = {} #username: row
+        self._leaderboard_complete = False #whether every user is in the cache
+        self._leaderboard_lock = threading.Lock()
+        
         self._funcs['add_user'] = self._daemonfuncs_add_user
         self._funcs['user_connected'] = self._daemonfuncs_user_connected
-        self._funcs['match_concluded'] = print
+        self._funcs['match_concluded'] = self._daemonfuncs_match_concluded
         self._funcs['make'] = self._daemonfuncs_make
-        self._funcs['get_user_data'] = self._daemonfuncs_get_user_data
+        self._funcs['get_user_data'] = self._readfuncs_get_user_data
         self._funcs['increment_user'] = self._daemonfuncs_increment_user
-        self._funcs['get_leaderboard'] = self._daemonfuncs_get_leaderboard
+        self._funcs['load_leaderboard'] = self._daemonfuncs_load_leaderboard
         self._funcs['purge_inactive'] = self._daemonfuncs_purge_inactive
-
-        if self.is_new:
-            self.make()
         
+        self._write_funcs += ['add_user', 'user_connected', 'match_concluded', 'increment_user', 'purge_inactive']
+        self._read_funcs += ['get_user_data']
+    
+    def get_leaderboard(self, num, offset = 0):
+        'Get num rows of the leaderboard starting at offset (num = -1 gets every row after offset). The database is only queried if the cache doesn\'t have enough rows'
+        with self._leaderboard_lock:
+            if self._leaderboard_complete or (num != -1 and offset + num <= len(self._leaderboard)):
+                return self._get_leaderboard_page(num, offset)
+        
+        if num == -1:
+            self._generic_func('load_leaderboard', -1)
+        else:
+            self._generic_func('load_leaderboard', max(offset + num, self.leaderboard_size))
+        
+        with self._leaderboard_lock:
+            return self._get_leaderboard_page(num, offset)
+    
+    def _get_leaderboard_page(self, num, offset):
+        if num == -1:
+            return self._leaderboard[offset:]
+        else:
+            return self._leaderboard[offset:offset + num]
+    
+    ###migrations - the database is made or upgraded by running these in order
+    
+    def _migration_users(self):
+        'The original users table'
+        self._db_connection.execute("""CREATE TABLE IF NOT EXISTS `users` (
+	`username`	TEXT,
+	`lastconn`	REAL,
+	`elo`	REAL,
+	`wins`	INTEGER,
+	`losses`	INTEGER,
+	`metadata`	TEXT
+)""")
+    
+    def _migration_keyed_users(self):
+        'Make username the primary key of the users table and index elo. If a username was in the old table more than once, only the first row is kept'
+        self._db_connection.execute("""CREATE TABLE `users_keyed` (
+	`username`	TEXT PRIMARY KEY,
+	`lastconn`	REAL,
+	`elo`	REAL,
+	`wins`	INTEGER,
+	`losses`	INTEGER,
+	`metadata`	TEXT
+)""")
+        self._db_connection.execute('INSERT INTO users_keyed SELECT * FROM users WHERE true ON CONFLICT (username) DO NOTHING')
+        self._db_connection.execute('DROP TABLE users')
+        self._db_connection.execute('ALTER TABLE users_keyed RENAME TO users')
+        self._db_connection.execute('CREATE INDEX `users_elo` ON `users` (`elo` DESC)')
+    
+    def _migration_matches(self):
+        'Match history - one row per match, and one row per player in each match'
+        self._db_connection.execute("""CREATE TABLE `matches` (
+	`id`	INTEGER PRIMARY KEY,
+	`map`	TEXT,
+	`gamemode`	INTEGER,
+	`started`	REAL,
+	`duration`	REAL,
+	`winner`	INTEGER,
+	`score0`	INTEGER,
+	`score1`	INTEGER
+)""")
+        self._db_connection.execute("""CREATE TABLE `match_players` (
+	`match_id`	INTEGER REFERENCES `matches` (`id`),
+	`username`	TEXT,
+	`team`	INTEGER,
+	`won`	INTEGER,
+	`elo_before`	REAL,
+	`elo_change`	REAL
+)""")
+        self._db_connection.execute('CREATE INDEX `match_players_username` ON `match_players` (`username`)')
+    
+    ###in-thread functions - should only be called by daemon
+    
     def _daemonfuncs_add_user(self, username):
         'Add a user to the database if the username doesn\'t already exist'
-        if self._daemonfuncs_get_user_data(username) is None:
-            self._db_connection.execute("INSERT INTO `users` VALUES ((?), (?), 1500.0, 0, 0, '{}')", (username, time.time()))
+        cursor = self._db_connection.execute("INSERT INTO `users` VALUES ((?), (?), 1500.0, 0, 0, '{}') ON CONFLICT (username) DO NOTHING", (username, time.time()))
+        
+        if cursor.rowcount == 1:
+            self._update_cached_user(username)
             self._log_wrapper('Added user {}'.format(username))
-            
         else:
             self._log_wrapper('Couldn\'t add user {} - already exists'.format(username))
     
     def _daemonfuncs_user_connected(self, username):
         'Add a user if they don\'t already exist. Update their last connection time if they do'
-        if self._daemonfuncs_get_user_data(username) is None:
-            self._daemonfuncs_add_user(username)
-        self._db_connection.execute("UPDATE users SET lastconn = (?) WHERE username = (?)", (time.time(), username))
+        self._db_connection.execute("INSERT INTO `users` VALUES ((?), (?), 1500.0, 0, 0, '{}') ON CONFLICT (username) DO UPDATE SET lastconn = excluded.lastconn", (username, time.time()))
+        
+        if username not in self._leaderboard_rows: #only new users change the leaderboard
+            self._update_cached_user(username)
         self._log_wrapper('User {} connected'.format(username))
     
-    def _daemonfuncs_get_user_data(self, username):
+    def _daemonfuncs_make(self):
+        'Make the \'users\' table in the database. Overwrites if it already exists'
+        self._db_connection.execute('DROP TABLE IF EXISTS users')
+        self._db_connection.execute('DROP TABLE IF EXISTS match_players')
+        self._db_connection.execute('DROP TABLE IF EXISTS matches')
+        self._db_connection.execute('PRAGMA user_version = 0')
+        self._db_connection.commit()
+        self._migrate()
+        self._invalidate_leaderboard()
+    
+    def _daemonfuncs_increment_user(self, username, elo = 0, wins = 0, losses = 0):
+        cursor = self._db_connection.execute('UPDATE users SET elo = elo + (?), wins = wins + (?), losses = losses + (?) WHERE username = (?)', (elo, wins, losses, username))
+        
+        if cursor.rowcount == 0:
+            self._log_wrapper('Couldn\'t find player "{}" in database'.format(username))
+        else:
+            self._update_cached_user(username)
+    
+    def _daemonfuncs_load_leaderboard(self, num):
+        'Fill the leaderboard cache with the top num rows (-1 for all rows)'
+        rows = self._db_connection.execute('SELECT username, elo, wins, losses FROM users ORDER BY elo DESC LIMIT (?)', (num,)).fetchall()
+        
+        with self._leaderboard_lock:
+            self._leaderboard = rows
+            self._leaderboard_keys = [0 - row[1] for row in rows]
+            self._leaderboard_rows = {row[0]: row for row in rows}
+            self._leaderboard_complete = num == -1 or len(rows) < num
+    
+    def _daemonfuncs_match_concluded(self, match):
+        """
+        Record a finished match and update the ratings, wins and losses of everyone who played in it, all in one transaction
+        
+        match = {'map': map name, 'gamemode': gamemode, 'started': start time, 'duration': seconds, 'winner': winning team or None for a draw, 'scores': [team 0, team 1], 'players': [{'username': username, 'team': team}, ...]}
+        """
+        usernames = [player['username'] for player in match['players']]
+        if len(usernames) == 0:
+            return
+        
+        self._db_connection.commit() #don't roll back unrelated writes if this fails
+        with self._db_connection:
+            self._db_connection.executemany("INSERT INTO `users` VALUES ((?), (?), 1500.0, 0, 0, '{}') ON CONFLICT (username) DO NOTHING", [(username, time.time()) for username in usernames])
+            
+            ratings = dict(self._db_connection.execute('SELECT username, elo FROM users WHERE username IN ({})'.format(', '.join(['?'] * len(usernames))), usernames).fetchall())
+            elo_changes = get_elo_changes(match['players'], ratings, match['winner'], self.elo_k_factor)
+            
+            cursor = self._db_connection.execute('INSERT INTO `matches` (map, gamemode, started, duration, winner, score0, score1) VALUES ((?), (?), (?), (?), (?), (?), (?))', (match['map'], match['gamemode'], match['started'], match['duration'], match['winner'], match['scores'][0], match['scores'][1]))
+            self._db_connection.executemany('INSERT INTO `match_players` VALUES ((?), (?), (?), (?), (?), (?))', [(cursor.lastrowid, player['username'], player['team'], player['team'] == match['winner'], ratings[player['username']], elo_changes[player['username']]) for player in match['players']])
+            
+            for player in match['players']:
+                if player['team'] == match['winner']:
+                    self._daemonfuncs_increment_user(player['username'], elo = elo_changes[player['username']], wins = 1)
+                else:
+                    self._daemonfuncs_increment_user(player['username'], elo = elo_changes[player['username']], losses = 1)
+        
+        self._log_wrapper('Recorded match {} on {} with {} player(s)'.format(cursor.lastrowid, match['map'], len(usernames)))
+    
+    def _daemonfuncs_purge_inactive(self, inactive_seconds):
+        self._db_connection.execute('DELETE FROM users WHERE lastconn < (?)', (time.time() - inactive_seconds,))
+        self._invalidate_leaderboard()
+    
+    ###read functions - called from any thread with a read connection
+    
+    def _readfuncs_get_user_data(self, connection, username):
         'Return all information on a user'
         'Finds the data for a user if they exist. If not, returns None'
-        data = self._db_connection.execute("SELECT * FROM users WHERE username = (?)", (username,)).fetchall()
+        data = connection.execute("SELECT * FROM users WHERE username = (?)", (username,)).fetchall()
         
         if len(data) == 0:
             self._log_wrapper('Couldn\'t find data for {}'.format(username))
@@ -115,41 +409,66 @@ class ServerDatabase(DBAccess):
             self._log_wrapper('Found data for {}, {} entry/entries'.format(username, len(data)))
             return data[0]
     
-    def _daemonfuncs_make(self):
-        'Make the \'users\' table in the database. Overwrites if it already exists'
-        self._db_connection.execute("""CREATE TABLE `users` (
-	`username`	TEXT,
-	`lastconn`	REAL,
-	`elo`	REAL,
-	`wins`	INTEGER,
-	`losses`	INTEGER,
-	`metadata`	TEXT
-)""")
+    ###leaderboard cache - updated by the daemon
     
-    def _daemonfuncs_increment_user(self, username, elo = 0, wins = 0, losses = 0):
-        if self._daemonfuncs_get_user_data(username) is None:
-            self._log_wrapper('Couldn\'t find player "{}" in database'.format(username))
+    def _update_cached_user(self, username):
+        'Move a user to their new place in the leaderboard cache after their row has changed'
+        row = self._db_connection.execute('SELECT username, elo, wins, losses FROM users WHERE username = (?)', (username,)).fetchone()
         
-        else:
-            self._db_connection.execute('UPDATE users SET elo = elo + (?), wins = wins + (?), losses = losses + (?) WHERE username = (?)', (elo, wins, losses, username))
+        with self._leaderboard_lock:
+            old_row = self._leaderboard_rows.pop(username, None)
+            if old_row is not None:
+                index = self._leaderboard.index(old_row)
+                self._leaderboard.pop(index)
+                self._leaderboard_keys.pop(index)
+            
+            #if the cache is only the top of the leaderboard, the user can only be placed if they are at least as high as the last cached row
+            if row is not None and (self._leaderboard_complete or (len(self._leaderboard) > 0 and row[1] >= self._leaderboard[-1][1])):
+                index = bisect.bisect_right(self._leaderboard_keys, 0 - row[1])
+                self._leaderboard.insert(index, row)
+                self._leaderboard_keys.insert(index, 0 - row[1])
+                self._leaderboard_rows[username] = row
     
-    def _daemonfuncs_get_leaderboard(self, num):
-        cursor = self._db_connection.execute('SELECT username, elo, wins, losses FROM users ORDER BY elo DESC')
+    def _invalidate_leaderboard(self):
+        with self._leaderboard_lock:
+            self._leaderboard = []
+            self._leaderboard_keys = []
+            self._leaderboard_rows = {}
+            self._leaderboard_complete = False
 
-        if num == -1:
-            return cursor.fetchall()
+
+def get_elo_changes(players, ratings, winner, k_factor = 32):
+    """
+    Calculate the change in rating for every player in a match. Each player is rated against the mean rating of everyone on other teams
+    
+    players = [{'username': username, 'team': team}, ...], ratings = {username: rating}, winner = winning team or None for a draw
+    """
+    team_ratings = {}
+    for player in players:
+        if player['team'] not in team_ratings:
+            team_ratings[player['team']] = []
+        team_ratings[player['team']].append(ratings[player['username']])
+    
+    changes = {}
+    for player in players:
+        opponent_ratings = []
+        for team, team_rating in team_ratings.items():
+            if team != player['team']:
+                opponent_ratings += team_rating
+        
+        if len(opponent_ratings) == 0: #nobody to win or lose against
+            changes[player['username']] = 0.0
         
         else:
-            i = 0
-            last_result = ''
-            output = []
-            while i < num and last_result is not None:
-                last_result = cursor.fetchone()
-                if last_result is not None:
-                    output.append(last_result)
-                i += 1
-
-            return output
+            expected = 1 / (1 + pow(10, ((sum(opponent_ratings) / len(opponent_ratings)) - ratings[player['username']]) / 400))
+            
+            if winner is None:
+                result = 0.5
+            elif player['team'] == winner:
+                result = 1
+            else:
+                result = 0
+            
+            changes[player['username']] = k_factor * (result - expected)
     
-    def _daemonfuncs_purge_inactive(self, inactive_seconds):
-        self._db_connection.execute('DELETE FROM users WHERE lastconn < (?)', (time.time() - inactive_seconds,))
\ No newline at end of file
+    return changes
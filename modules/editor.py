@@ -5,6 +5,7 @@ import functools
 import json
 
 import modules.modloader
+import modules.config
 
 
 class Map:
@@ -23,6 +24,7 @@ class Map:
         'Writes text to a file in the map folder'
         with open(os.path.join(self.path, path), 'w') as file:
             file.write(text)
+        modules.config.service.forget(os.path.join(self.path, path))
     
     def get_json(self, path):
         'Gets data from a json file in the map folder and reads it'
@@ -34,6 +36,7 @@ class Map:
         'Writes data to a json file in the map folder'
         with open(os.path.join(self.path, path), 'w') as file:
             json.dump(data, file, sort_keys=True, indent='\t')
+        modules.config.service.forget(os.path.join(self.path, path))
 
 
 class EditorSnapin:
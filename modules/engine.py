@@ -13,6 +13,8 @@ import importlib.util
 import modules.netclients
 import modules.quicklogs
 import modules.bettercanvas
+import modules.lightcalc
+import modules.config
 
 
 class Game:
@@ -27,14 +29,15 @@ class Game:
             name = 'localhost'
         self.server = server
         
-        self.log = modules.quicklogs.Log(os.path.join(sys.path[0], 'user', 'logs', 'client recv.txt'))
-        
         self.vars = {}
         
-        with open(os.path.join(sys.path[0], 'user', 'config.json'), 'r') as file:
-            self.settingsdict = json.load(file)
+        self.settingsdict = modules.config.service.get('user')
+        
+        self.log = modules.quicklogs.Log.from_config(os.path.join(sys.path[0], 'user', 'logs', 'client recv.txt'), self.settingsdict.get('logs', {}))
         
         self.canvcont = modules.bettercanvas.CanvasController(self.canvas, self, get_pil = self.settingsdict['graphics']['PILrender'])
+        if self.settingsdict['graphics'].get('batch canvas updates', False):
+            self.canvcont.start_batching(1 / self.settingsdict['graphics'].get('canvas flush rate', 60))
         
         self.message_pipe, pipe = mp.Pipe()
         self.messagedisplay = CanvasMessages(self.canvcont, pipe)
@@ -95,9 +98,15 @@ class Game:
         self.running = False
         self.engine.keybindhandler.kill()
         self.engine.unload_current_map()
+        self.canvcont.stop_batching()
+        
+        #a new game makes new logs, so stop this one's writer threads
+        self.engine.log.close()
+        self.log.close()
     
     def recv_handler(self, request):
-        self.log.add('received', 'Data received from the server - {}'.format(request.pretty_print()))
+        if self.log.is_enabled('debug'):
+            self.log.add('received', 'Data received from the server - {}'.format(request.pretty_print()), level = 'debug')
         
         if request.command == 'say':
             if 'category' in request.arguments:
@@ -205,6 +214,7 @@ class Game:
                         item.attributes.ticket = data['ticket']
                         
                         self.engine.current_map.items.append(item)
+                        self.engine.update_item_light(item, data['position'])
                         
                     elif data['type'] == 'remove':
                         to_remove = []
@@ -215,6 +225,9 @@ class Game:
                         for item in to_remove:
                             item.destroy()
                             self.engine.current_map.items.remove(item)
+                        
+                        if self.engine.current_map.dynamic_lights is not None:
+                            self.engine.current_map.dynamic_lights.remove_light(data['ticket'])
                     
                     elif data['type'] == 'update position':
                         to_update = []
@@ -225,6 +238,7 @@ class Game:
                         for item in to_update:
                             item.set(x = data['position'][0],
                                      y = data['position'][1])
+                            self.engine.update_item_light(item, data['position'])
                     
                     elif data['type'] == 'animation':
                         current_item = None
@@ -295,6 +309,7 @@ class Engine:
             event_overlays = {}
             player = None
             lightmap = None
+            dynamic_lights = None
             
             name = None
             path = None
@@ -337,8 +352,7 @@ class Engine:
         self.debug = debug
         
         #check user cfg
-        with open(os.path.join(sys.path[0], 'user', 'config.json'), 'r') as file:
-            self.cfgs.user = json.load(file)
+        self.cfgs.user = modules.config.service.get('user')
         
         #get debugging settings
         with open(os.path.join(sys.path[0], 'user', 'debug.json'), 'r') as file:
@@ -381,6 +395,9 @@ class Engine:
             #unload current map
             self.unload_current_map()
             
+            #read the map's files again, in case they were edited since it was last loaded
+            modules.config.service.forget(path)
+            
             #set new map name and path
             self.current_map.path = path
             self.current_map.name = name
@@ -400,16 +417,31 @@ class Engine:
                 self.cfgs.current_map = json.load(file)
             self.game.message_pipe.send(['map load', 'Loaded map cfg'])
 
+            #reset the camera to the top left of the new map
+            self.game.canvcont.set_view_size(*self.cfgs.user['graphics']['resolution'])
+            self.game.canvcont.set_camera(0, 0, force = True)
+            
             #find overlay/lightmap/base position
             c_x = (self.cfgs.user['graphics']['resolution'][0] / 2) + 4
             c_y = (self.cfgs.user['graphics']['resolution'][1] / 2) + 2
             
+            #models that never change are drawn onto a few large images instead of having their own canvas objects
+            bake_statics = self.cfgs.user['graphics']['PILrender'] and self.cfgs.user['graphics'].get('bake static panels', False)
+            to_bake = []
+            
             #load and render base and overlay textures
             if self.cfgs.current_map['background']['base'] is None:
                 self.game.message_pipe.send(['map load', 'No base texture'])
             else:
-                self.current_map.statics.base = modules.bettercanvas.Model(self.game.canvcont, self.cfgs.current_map['background']['base'], self.current_map.path, 'base texture')
+                self.current_map.statics.base = modules.bettercanvas.Model(self.game.canvcont, self.cfgs.current_map['background']['base'], self.current_map.path, 'base texture', render = not bake_statics)
                 self.current_map.statics.base.set(x = c_x, y = c_y)
+                
+                if bake_statics:
+                    if self.current_map.statics.base.attributes.anim_controller.run_loop:
+                        self.current_map.statics.base.make_canvas_objects()
+                    else:
+                        to_bake.append(self.current_map.statics.base)
+                
                 self.game.message_pipe.send(['map load', 'Loaded base texture'])
             
             if self.cfgs.current_map['background']['overlay'] is None:
@@ -420,12 +452,20 @@ class Engine:
                 self.game.message_pipe.send(['map load', 'Loaded overlay texture'])
             
             #create lightmap model
-            self.current_map.lightmap = modules.bettercanvas.Model(self.game.canvcont, os.path.join('system', 'lightmap'), self.current_map.path, 'lightmap')
-            self.current_map.lightmap.setpos(c_x, c_y)
+            if self.cfgs.user['graphics']['PILrender'] and self.cfgs.user['graphics'].get('dynamic lights', False):
+                lightmap_path = os.path.join(self.current_map.path, 'models', 'system', 'lightmap', 'lightmap.png')
+                with __import__('PIL.Image').Image.open(lightmap_path) as image:
+                    origin = [c_x - (image.size[0] / 2), c_y - (image.size[1] / 2)] #line up with where the lightmap model would have been
+                
+                self.current_map.dynamic_lights = DynamicLightmap(self.game.canvcont, lightmap_path, origin, self.cfgs.current_map['lighting'], 'lightmap', self.cfgs.user['graphics'].get('dynamic light tile size', 64), self.cfgs.user['graphics'].get('dynamic light budget', 0.005), self.cfgs.user['graphics'].get('dynamic light rate', 30))
+                self.game.message_pipe.send(['map load', 'Loaded dynamic lightmap'])
+            else:
+                self.current_map.lightmap = modules.bettercanvas.Model(self.game.canvcont, os.path.join('system', 'lightmap'), self.current_map.path, 'lightmap')
+                self.current_map.lightmap.setpos(c_x, c_y)
             
             #load all event textures into memory
             for name in self.cfgs.user['hud']['overlays']:
-                self.current_map.event_overlays[name] = modules.bettercanvas.Model(self.game.canvcont, self.cfgs.user['hud']['overlays'][name], self.current_map.path, 'event overlays')
+                self.current_map.event_overlays[name] = modules.bettercanvas.Model(self.game.canvcont, self.cfgs.user['hud']['overlays'][name], self.current_map.path, 'event overlays', screen_space = True)
                 self.current_map.event_overlays[name].set(x = c_x, y = c_y, rotation = 0, transparency = 0)
             
             #open layout
@@ -447,13 +487,23 @@ class Engine:
             #make layout panels
             anim_panels = []
             for panel in self.cfgs.layout['geometry']:
-                panel_object = Panel(self.game.canvcont, panel['material'], self.current_map.path, 'map panels', autoplay_anims = False)
+                panel_object = Panel(self.game.canvcont, panel['material'], self.current_map.path, 'map panels', autoplay_anims = False, render = not bake_statics)
                 panel_object.load_scripts(self.current_map.materials.scripts)
                 panel_object.set(x = panel['coordinates'][0], y = panel['coordinates'][1])
                 self.current_map.statics.panels.append(panel_object)
                 
+                if bake_statics:
+                    if panel_object.attributes.anim_controller.run_loop or len(panel_object.attributes.scripts) > 0: #animated and scripted panels stay as live models
+                        panel_object.make_canvas_objects()
+                    else:
+                        to_bake.append(panel_object)
+                
                 if panel_object.attributes.anim_controller.run_loop:
                     anim_panels.append(panel_object)
+            
+            if bake_statics:
+                self.bake_statics(to_bake)
+                self.game.message_pipe.send(['map load', 'Baked {} static models'.format(len(to_bake))])
         
             self.game.canvcont.set_time(time.time() + self.cfgs.current_map['animation']['sync window'][self.cfgs.user['graphics']['model quality']])
             
@@ -487,8 +537,7 @@ class Engine:
             self.hud.invdisp.select_index(0)
             
             #set up binds for inventory display
-            with open(os.path.join(sys.path[0], 'user', 'keybinds.json'), 'r') as file:
-                keybinds_data = json.load(file)
+            keybinds_data = modules.config.service.get('keybinds')
             self.keybindhandler.bind(keybinds_data['inventory']['slot0'], lambda: self.hud.invdisp.select_index(0))
             self.keybindhandler.bind(keybinds_data['inventory']['slot1'], lambda: self.hud.invdisp.select_index(1))
             self.keybindhandler.bind(keybinds_data['inventory']['slot2'], lambda: self.hud.invdisp.select_index(2))
@@ -508,7 +557,41 @@ class Engine:
             self.game.scoreline_display.pos.x = self.game.canvas.winfo_width() / 2
             self.game.scoreline_display.refresh()
     
+    def bake_statics(self, models):
+        'Composite models onto chunk-sized tiles, with one canvas object per tile'
+        PILImage = __import__('PIL.Image').Image
+        
+        image = PILImage.new('RGBA', (self.cfgs.current_map['geometry'][0], self.cfgs.current_map['geometry'][1]), (0, 0, 0, 0))
+        for model in models:
+            model.bake_onto(image)
+        
+        chunk_x, chunk_y = self.cfgs.layout['chunk sizes']
+        for x in range(0, image.size[0], chunk_x):
+            for y in range(0, image.size[1], chunk_y):
+                tile = image.crop((x, y, min(x + chunk_x, image.size[0]), min(y + chunk_y, image.size[1])))
+                
+                if tile.getbbox() is not None: #don't make objects for empty tiles
+                    self.game.canvcont.add_tile(x, y, tile, 'base texture') #tiles are only put on the canvas when the camera can see them
+    
+    def update_item_light(self, item, position):
+        'Move the dynamic light given off by an item (if it has one)'
+        if self.current_map.dynamic_lights is not None and 'light' in item.cfgs.item:
+            self.current_map.dynamic_lights.set_light(item.attributes.ticket, position[0], position[1], item.cfgs.item['light']['emit'], item.cfgs.item['light']['radius'])
+    
+    def update_camera(self):
+        'Centre the camera on the player without showing anything outside of the map'
+        if self.current_map.player is not None:
+            view_width, view_height = self.cfgs.user['graphics']['resolution']
+            map_width, map_height = self.cfgs.current_map['geometry']
+            
+            x = min(max(0, self.current_map.player.attributes.pos.x - (view_width / 2)), max(0, map_width - view_width))
+            y = min(max(0, self.current_map.player.attributes.pos.y - (view_height / 2)), max(0, map_height - view_height))
+            
+            self.game.canvcont.set_camera(int(x), int(y))
+    
     def unload_current_map(self):
+        self.game.canvcont.clear_tiles()
+        
         for scatter in self.current_map.statics.scatters:
             scatter.destroy()
         self.current_map.scatters = []
@@ -529,6 +612,10 @@ class Engine:
             self.current_map.lightmap.destroy()
             self.current_map.lightmap = None
         
+        if self.current_map.dynamic_lights is not None:
+            self.current_map.dynamic_lights.stop()
+            self.current_map.dynamic_lights = None
+        
         self.current_map.materials.data = None
         self.current_map.materials.scripts = {}
         
@@ -597,7 +684,8 @@ class Engine:
     
     def use_current_item(self):
         if self.hud.invdisp.get_slot_info(self.hud.invdisp.selection_index)['quantity'] > 0:
-            angle = self.angle(self.game.canvas.winfo_pointerx() - self.game.canvas.winfo_rootx() - self.current_map.player.attributes.pos.x, self.game.canvas.winfo_pointery() - self.game.canvas.winfo_rooty() - self.current_map.player.attributes.pos.y)
+            pointer_x, pointer_y = self.game.canvcont.screen_to_world(self.game.canvas.winfo_pointerx() - self.game.canvas.winfo_rootx(), self.game.canvas.winfo_pointery() - self.game.canvas.winfo_rooty())
+            angle = self.angle(pointer_x - self.current_map.player.attributes.pos.x, pointer_y - self.current_map.player.attributes.pos.y)
             angle = math.degrees(angle)
             
             self.game.client.use_item(self.hud.invdisp.get_slot_info(self.hud.invdisp.selection_index)['file name'], angle, [self.current_map.player.attributes.pos.x, self.current_map.player.attributes.pos.y], self.hud.invdisp.selection_index)
@@ -664,8 +752,9 @@ class Engine:
     def _player_rotationd(self):
         while self.running:
             while self.current_map.player is not None:
-                self.current_map.player.set(rotation = self.snap_angle(math.degrees(self.angle(self.keybindhandler.mouse.x - self.current_map.player.attributes.pos.x,
-                                                                                               self.keybindhandler.mouse.y - self.current_map.player.attributes.pos.y))))
+                mouse_x, mouse_y = self.game.canvcont.screen_to_world(self.keybindhandler.mouse.x, self.keybindhandler.mouse.y)
+                self.current_map.player.set(rotation = self.snap_angle(math.degrees(self.angle(mouse_x - self.current_map.player.attributes.pos.x,
+                                                                                               mouse_y - self.current_map.player.attributes.pos.y))))
                 time.sleep(0.1)
             time.sleep(0.1)
         
@@ -839,7 +928,7 @@ class KeyBind:
     
     def bind(self, keysym, func):
         """Keysym can be a string or a list of strings"""
-        if type(keysym) == list:
+        if type(keysym) in [list, tuple]:
             [self.bind(key, func) for key in keysym]
         elif keysym in self.binds:
             self.binds[keysym].append(func)
@@ -857,7 +946,7 @@ class KeyBind:
         self.binds = {}
     
     def get_state(self, keysym):
-        if type(keysym) == list:
+        if type(keysym) in [list, tuple]:
             for key in keysym:
                 if self.get_state(key):
                     return True
@@ -1057,8 +1146,7 @@ class PopMessage:
             y = 0
         self.graphical_properties = graphical_properties
 
-        with open(os.path.join(sys.path[0], 'user', 'config.json'), 'r') as file:
-            settingsdata = json.load(file)
+        settingsdata = modules.config.service.get('user')
         
         self.graphical_properties.x = settingsdata['graphics']['resolution'][0] / 2
         self.graphical_properties.y = settingsdata['graphics']['resolution'][1] / 2
@@ -1158,14 +1246,57 @@ class DynamicStringDisplay:
         
         self.refresh()
 
+class DynamicLightmap:
+    """
+    Shows the baked lightmap as tiles with moving lights (e.g. from items) added on top. Tiles that have changed are redrawn by a daemon, which spends no more than budget seconds on each frame
+    """
+    def __init__(self, canvcont, image_path, origin, lighting, layer, tile_size = 64, budget = 0.005, rate = 30):
+        self.canvcont = canvcont
+        self.budget = budget
+        self.rate = rate
+        
+        self.PILImage = __import__('PIL.Image').Image
+        
+        with self.PILImage.open(image_path) as image:
+            image = image.convert('RGBA')
+            self.light_layer = modules.lightcalc.DynamicLightLayer(modules.lightcalc.rgba_to_values(image), origin, lighting, tile_size)
+            
+            self.tiles = []
+            for box in self.light_layer.tiles:
+                self.tiles.append(self.canvcont.add_tile(origin[0] + box[0], origin[1] + box[1], image.crop(box), layer))
+        
+        self.running = True
+        threading.Thread(target = self._redrawd, name = 'Dynamic light redraw', daemon = True).start()
+    
+    def set_light(self, key, x, y, emit, radius):
+        self.light_layer.set_light(key, x, y, emit, radius)
+    
+    def remove_light(self, key):
+        self.light_layer.remove_light(key)
+    
+    def stop(self):
+        self.running = False
+    
+    def _redrawd(self):
+        while self.running:
+            frame_start = time.time()
+            
+            for i, rgba in self.light_layer.changed_tiles():
+                self.canvcont.set_tile_image(self.tiles[i], self.PILImage.fromarray(rgba, 'RGBA'))
+                
+                if time.time() - frame_start >= self.budget: #leave the rest of the tiles until the next frame
+                    break
+            
+            time.sleep(max(0, (1 / self.rate) - (time.time() - frame_start)))
+
+
 class Panel(modules.bettercanvas.Model):
-    def __init__(self, canvas_controller, mat_name, map_path, layer, autoplay_anims = True):
+    def __init__(self, canvas_controller, mat_name, map_path, layer, autoplay_anims = True, render = True):
         self.mat_name = mat_name
         
-        with open(os.path.join(map_path, 'materials', mat_name), 'r') as file:
-            mat_cfg = json.load(file)
+        mat_cfg = modules.config.service.get_file(os.path.join(map_path, 'materials', mat_name))
         
-        super().__init__(canvas_controller, mat_cfg['model'], map_path, layer, autoplay_anims)
+        super().__init__(canvas_controller, mat_cfg['model'], map_path, layer, autoplay_anims, render)
         
         self.cfgs.material = mat_cfg
         
@@ -1274,8 +1405,7 @@ class Entity(modules.bettercanvas.Model):
                 time.sleep(delay)
     
     def _velocityd(self):
-        with open(os.path.join(sys.path[0], 'user', 'keybinds.json'), 'r') as file:
-            keybind_data = json.load(file)
+        keybind_data = modules.config.service.get('keybinds')
         
         while self.attributes.running:
             time.sleep(self.attributes.pos.velocity.delay)
@@ -1431,14 +1561,16 @@ class Entity(modules.bettercanvas.Model):
             
             #update the entity model's position
             self.set(force = True)
+            
+            if self.attributes.is_player and not self.attributes.server_controlled:
+                self.engine.update_camera()
 
 
 class Item(Entity):
     def __init__(self, item_name, map_path, engine, layer):
         self.item_name = item_name
         
-        with open(os.path.join(map_path, 'items', item_name), 'r') as file:
-            item_cfg = json.load(file)
+        item_cfg = modules.config.service.get_file(os.path.join(map_path, 'items', item_name)) #read from disk once per map load, not once per projectile
         
         super().__init__(item_cfg['model'], map_path, engine, layer, is_player = False, server_controlled = True)
         
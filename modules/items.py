@@ -1,9 +1,24 @@
-import json
-import os
-import sys
 import math
 
 
+class ItemDefinition:
+    'Everything about an item that stays the same while a map is loaded. Made by Lobby.load_map and shared by every instance of the item'
+    def __init__(self, name, cfg, script):
+        self.name = name
+        self.cfg = cfg
+        self.script = script #ItemScript subclass named by the item's control script
+        
+        self.speed = self.cfg['speed']
+        self.use_cooldown = self.cfg['use cooldown']
+        
+        if self.cfg['hitbox']['type'] == 'circular':
+            self.hitbox_shape = 'circle'
+            self.hitbox_radius = self.cfg['hitbox']['radius']
+        else:
+            self.hitbox_shape = None
+            self.hitbox_radius = 0
+
+
 class ItemScript:
     internal_name = ''
     
@@ -45,16 +60,15 @@ class ItemScript:
             item = {}
         self.cfgs = cfgs
         
-        with open(os.path.join(sys.path[0], 'server', 'maps', self.lobby.map.name, 'items', name), 'r') as file:
-            self.cfgs.item = json.load(file)
+        self.definition = self.lobby.items.definitions[name] #loaded with the map, so making an item doesn't touch the disk
+        self.cfgs.item = self.definition.cfg
        
         self.attributes.name = name
         self.cfgs.current_map = self.lobby.map.data
         self.attributes.tickrate = self.lobby.tickrate
         
-        if self.cfgs.item['hitbox']['type'] == 'circular':
-            self.attributes.hitbox.shape = 'circle'
-            self.attributes.hitbox.radius = self.cfgs.item['hitbox']['radius']
+        self.attributes.hitbox.shape = self.definition.hitbox_shape
+        self.attributes.hitbox.radius = self.definition.hitbox_radius
     
     def inside_map(self):
         if self.attributes.hitbox.shape == 'circle':
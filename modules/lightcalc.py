@@ -1,37 +1,91 @@
 import modules.lineintersection
 import math
+import time
+import json
+import threading
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
 
-class CalcSegment:
-    def __init__(self, x0, x1, ycap, pipe, map_data, materials, light_sources, blocking_panels, shadows = True):
-        self.pipe = pipe
+class LightCalc:
+    """
+    Base for the lightmap calculators. Subclasses must implement calc_area
+    """
+    tile_scale = 1 #how much bigger than the configured tile size this calculator's tiles should be
+    
+    def __init__(self, map_data, materials, light_sources, blocking_panels, shadows = True, shadow_wedges = True):
         self.map_data = map_data
         self.materials = materials
         self.light_sources = light_sources
         self.blocking_panels = blocking_panels
         self.shadows = shadows
         
-        xinc = 1
-        yinc = 1
-        if self.map_data['grid']['apply to lightmap']:
-            xinc = self.map_data['grid']['mult']['x']
-            yinc = self.map_data['grid']['mult']['y']
+        self.blockers_hit = set() #indexes of the blocking panels that have cast a shadow in the current tile
+        
+        #work out the edges and bounding box of every blocking panel once, instead of for every line that is tested
+        self.occluders = [] #the amount of light each blocking panel blocks, the edges of its hitbox and its bounding box
+        for panel in self.blocking_panels:
+            self.occluders.append([self.materials[panel['material']]['light']['block'], get_occluder_edges(panel, self.materials), get_panel_box(panel, self.materials)])
+        
+        self.grid = OccluderGrid([box for block, edges, box in self.occluders])
         
-        for x in range(x0, x1, xinc):
-            self.pipe.send(['message', '{}-{} at {}'.format(x0, x1, x)])
-            for y in range(1, ycap, yinc):
-                self.pipe.send([[x, y], self.calc_light(int((x / xinc) + 1) * xinc, int((y / yinc) + 1) * yinc)])
-        self.pipe.send('done')
+        #the area each blocking panel could cast a shadow over from each light
+        if shadow_wedges:
+            self.wedges = [[get_shadow_wedge(source['coordinates'], box) for block, edges, box in self.occluders] for source in self.light_sources]
+        else:
+            self.wedges = None
+    
+    def render(self, width, height):
+        'Calculate the light level of every pixel in a lightmap. Returns an array indexed [y, x]'
+        values = np.zeros((height, width), dtype = np.uint8) #the top row and left column are never calculated, so they are left dark
+        self.render_tile(values, [1, 1, width, height])
+        return values
+    
+    def render_preview(self, width, height, step):
+        'Quickly calculate a rough lightmap by only sampling every step-th cell in each direction and bilinearly scaling the result up. Returns an array indexed [y, x]'
+        xinc, yinc = get_cell_size(self.map_data)
+        
+        #sample the same points as the full lightmap would for the first cell in each group of cells
+        x_starts = get_sample_coords(1, width, xinc * step)[0]
+        y_starts = get_sample_coords(1, height, yinc * step)[0]
+        x_samples = get_sample_coords(x_starts, None, xinc)[1]
+        y_samples = get_sample_coords(y_starts, None, yinc)[1]
+        
+        self.blockers_hit = set()
+        cells = self.calc_area(x_samples, y_samples)
+        
+        values = np.zeros((height, width), dtype = np.uint8)
+        values[1:, 1:] = upscale_bilinear(cells, x_starts + ((xinc * step) / 2), y_starts + ((yinc * step) / 2), np.arange(1, width), np.arange(1, height))
+        return values
+    
+    def render_tile(self, values, box):
+        'Calculate the light level of every pixel in a box ([x0, y0, x1, y1], where y0 is on the cell grid) and write them into an array of light levels. Returns the indexes of the blocking panels that cast a shadow in the box'
+        self.blockers_hit = set()
+        x0, y0, x1, y1 = box
+        xinc, yinc = get_cell_size(self.map_data)
+        
+        #columns are looked up one by one, as they don't all follow the same cell grid (see get_column_cells)
+        x_samples, x_index = np.unique(get_sample_coords(get_column_cells(np.arange(x0, x1), self.map_data['geometry'][0], xinc), None, xinc)[1], return_inverse = True)
+        y_starts, y_samples = get_sample_coords(y0, y1, yinc)
+        
+        values[y0:y1, x0:x1] = np.repeat(self.calc_area(x_samples, y_samples), yinc, axis = 0)[:y1 - y0][:, x_index]
+        return sorted(self.blockers_hit)
+    
+    def calc_area(self, xs, ys):
+        'Calculate the light level at every combination of the x and y coordinates given. Returns an array indexed [y, x]'
+        raise NotImplementedError()
+
+
+class CellCalc(LightCalc):
+    """
+    Calculates the lightmap one cell at a time in stock python
+    """
+    def calc_area(self, xs, ys):
+        return np.array([[self.calc_light(x, y) for x in xs] for y in ys])
     
     def calc_light(self, x, y):
         light_level = self.map_data['lighting']['background']
-        for source in self.light_sources:
-            if self.shadows:
-                passthroughs = []
-                for panel in self.blocking_panels:
-                    result = self.line_passes_through(x, y, *source['coordinates'], panel)
-                    if not result == False:
-                        passthroughs.append([result, panel])
-        
+        for light_index, source in enumerate(self.light_sources):
             dist = math.hypot(x - source['coordinates'][0], y - source['coordinates'][1]) * self.map_data['lighting']['dist mult']
             
             if dist == 0:
@@ -39,45 +93,657 @@ class CalcSegment:
             else:
                 source_light = (1 / pow(dist * self.map_data['lighting']['dist mult'], 2)) * self.materials[source['material']]['light']['emit']
                 if self.shadows:
-                    for distance, panel in passthroughs:
-                        if self.materials[panel['material']]['light']['block'] == 1: #don't bother doing the light calcuation if one of the panels will block all light
-                            source_light = 0
-                        else:
-                            source_light -= distance * self.materials[panel['material']]['light']['block'] * self.map_data['lighting']['dist mult']
+                    for i in self.get_candidates(light_index, x, y):
+                        block, edges, box = self.occluders[i]
+                        result = self.line_passes_through(x, y, *source['coordinates'], edges)
+                        if not result == False:
+                            self.blockers_hit.add(i)
+                            
+                            if block == 1: #don't bother doing the light calcuation if one of the panels will block all light
+                                source_light = 0
+                            else:
+                                source_light -= result * block * self.map_data['lighting']['dist mult']
             
             light_level += source_light
                 
         return int((min(light_level, self.map_data['lighting']['dynamic range']) / self.map_data['lighting']['dynamic range']) * 255)
+    
+    def get_candidates(self, light_index, x, y):
+        'Get the indexes of the blocking panels that the line from a point to a light could pass through, in order'
+        source_x, source_y = self.light_sources[light_index]['coordinates']
+        
+        if self.wedges is None:
+            return self.grid.query(x, y, source_x, source_y)
+        else:
+            angle = math.atan2(y - source_y, x - source_x)
+            length = math.hypot(x - source_x, y - source_y)
+            return [i for i, wedge in enumerate(self.wedges[light_index]) if in_wedge(wedge, angle, length)]
 
-    def line_passes_through(self, x0, y0, x1, y1, panel):
-        'Get light sources with a line of sight on coordinates'
-        last_x = None
-        last_y = None
-        i = 0
+    def line_passes_through(self, x0, y0, x1, y1, edges):
+        'Find the distance that a line travels through a panel, or False if it doesn\'t pass through it'
         intersections = []
-        for pan_x, pan_y in self.materials[panel['material']]['hitbox']:
-            pan_x += panel['coordinates'][0]
-            pan_y += panel['coordinates'][1]
+        for edge in edges:
+            result = modules.lineintersection.wrap_np_seg_intersect(edge, [[x0, y0], [x1, y1]], considerCollinearOverlapAsIntersect = True)
+            if not (type(result) == bool or result is None):
+                intersections.append([result[0], result[1]])
             
-            i += 1
-            if not last_x == None:
-                if i == len(self.materials[panel['material']]['hitbox']):
-                    last_x = self.materials[panel['material']]['hitbox'][0][0] + panel['coordinates'][0]
-                    last_y = self.materials[panel['material']]['hitbox'][0][1] + panel['coordinates'][1]
-                
-                result = modules.lineintersection.wrap_np_seg_intersect([[last_x, last_y], [pan_x, pan_y]], [[x0, y0], [x1, y1]], considerCollinearOverlapAsIntersect = True)
-                if not (type(result) == bool or result is None):
-                    intersections.append([result[0], result[1]])
-                
-                elif result == True: #co linear overlap
-                    intersections.append([0, 0])
-            
-            last_x = pan_x
-            last_y = pan_y
+            elif result == True: #co linear overlap
+                intersections.append([0, 0])
         
         if intersections == []:
             return False
         else:
             if len(intersections) == 1:
                 intersections.append([x0, y0])
-            return math.hypot(intersections[0][0] - intersections[1][0], intersections[1][1] - intersections[0][1])
\ No newline at end of file
+            return math.hypot(intersections[0][0] - intersections[1][0], intersections[1][1] - intersections[0][1])
+
+
+class VectorCalc(LightCalc):
+    """
+    Calculates whole areas of the lightmap at once using NumPy arrays instead of one cell at a time. Gives the same light levels as CellCalc.calc_light
+    """
+    tile_scale = 8 #each array operation has a fixed cost, so small tiles are much slower per cell
+    
+    def calc_area(self, xs, ys):
+        x, y = np.meshgrid(np.asarray(xs, dtype = float), np.asarray(ys, dtype = float))
+        
+        light_level = np.full(x.shape, float(self.map_data['lighting']['background']))
+        for light_index, source in enumerate(self.light_sources):
+            source_x, source_y = source['coordinates']
+            emit = self.materials[source['material']]['light']['emit']
+            
+            dist = np.hypot(x - source_x, y - source_y) * self.map_data['lighting']['dist mult']
+            lit = dist != 0
+            
+            with np.errstate(divide = 'ignore'):
+                source_light = np.where(lit, (1 / np.power(dist * self.map_data['lighting']['dist mult'], 2)) * emit, emit)
+            
+            if self.shadows:
+                if self.wedges is not None:
+                    angles = np.arctan2(y - source_y, x - source_x)
+                    lengths = np.hypot(x - source_x, y - source_y)
+                
+                for i, (block, edges, box) in enumerate(self.occluders):
+                    #only test the points that this panel could cast a shadow on
+                    if self.wedges is None:
+                        affected = lit
+                    else:
+                        affected = lit & in_wedge(self.wedges[light_index][i], angles, lengths)
+                    
+                    if affected.any():
+                        passes, distance = self.passes_through(x[affected], y[affected], source_x, source_y, edges)
+                        
+                        if passes.any():
+                            self.blockers_hit.add(i)
+                            
+                            if block == 1:
+                                source_light[affected] = np.where(passes, 0, source_light[affected])
+                            else:
+                                source_light[affected] = np.where(passes, source_light[affected] - distance * block * self.map_data['lighting']['dist mult'], source_light[affected])
+            
+            light_level += source_light
+        
+        return np.trunc((np.minimum(light_level, self.map_data['lighting']['dynamic range']) / self.map_data['lighting']['dynamic range']) * 255).astype(int)
+    
+    def passes_through(self, x, y, source_x, source_y, edges):
+        'Find which of the lines from each point to the light source pass through a panel, and the distance they travel inside it'
+        count = np.zeros(x.shape, dtype = int)
+        first_x = x.copy()
+        first_y = y.copy()
+        second_x = x.copy() #if only one edge is crossed, the second point is the start of the line
+        second_y = y.copy()
+        
+        for edge in edges:
+            hit, hit_x, hit_y = self.intersect(x, y, source_x, source_y, edge)
+            
+            is_first = hit & (count == 0)
+            is_second = hit & (count == 1)
+            first_x = np.where(is_first, hit_x, first_x)
+            first_y = np.where(is_first, hit_y, first_y)
+            second_x = np.where(is_second, hit_x, second_x)
+            second_y = np.where(is_second, hit_y, second_y)
+            
+            count += hit
+        
+        distance = np.hypot(first_x - second_x, second_y - first_y)
+        return (count > 0) & (distance != 0), distance #CellCalc treats a distance of 0 (e.g. a line touching a corner) as not passing through
+    
+    def intersect(self, x, y, source_x, source_y, edge):
+        'Intersect an edge with the lines from each point to the light source. Mirrors modules.lineintersection.np_seg_intersect'
+        (edge_x0, edge_y0), (edge_x1, edge_y1) = edge
+        
+        r_x = edge_x1 - edge_x0
+        r_y = edge_y1 - edge_y0
+        s_x = source_x - x
+        s_y = source_y - y
+        v_x = x - edge_x0
+        v_y = y - edge_y0
+        
+        num = v_x * r_y - v_y * r_x
+        denom = r_x * s_y - r_y * s_x
+        
+        parallel = np.abs(denom) <= 1e-8
+        collinear = parallel & (np.abs(num) <= 1e-8)
+        
+        #collinear overlaps count as an intersection at (0, 0)
+        v_dot_r = v_x * r_x + v_y * r_y
+        a_dot_s = 0 - (v_x * s_x + v_y * s_y)
+        overlaps = collinear & (((0 <= v_dot_r) & (v_dot_r <= r_x * r_x + r_y * r_y)) | ((0 <= a_dot_s) & (a_dot_s <= s_x * s_x + s_y * s_y)))
+        
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            u = num / denom
+            t = (v_x * s_y - v_y * s_x) / denom
+            crosses = np.logical_not(parallel) & (u >= 0) & (u <= 1) & (t >= 0) & (t <= 1)
+            
+            hit_x = np.where(crosses, x + s_x * u, 0)
+            hit_y = np.where(crosses, y + s_y * u, 0)
+        return crosses | overlaps, hit_x, hit_y
+
+
+class TileScheduler:
+    """
+    Splits a lightmap into small tiles and hands them out to a pool of worker processes as they become free
+    """
+    def __init__(self, map_data, materials, light_sources, blocking_panels, shadows = True, workers = 8, renderer = 'cells', tile_size = 32, tiles = None, shadow_wedges = True):
+        self.map_data = map_data
+        self.materials = materials
+        self.light_sources = light_sources
+        self.blocking_panels = blocking_panels
+        self.shadows = shadows
+        self.shadow_wedges = shadow_wedges
+        self.workers = max(1, workers)
+        self.renderer = renderer
+        
+        self.width, self.height = self.map_data['geometry']
+        if tiles is None:
+            self.tiles = make_tiles(self.width, self.height, *get_cell_size(self.map_data), tile_size * renderers[self.renderer].tile_scale)
+        else:
+            self.tiles = tiles #only recalculate some tiles
+        
+        self.dependencies = {} #the lights and blocking panels that affected each tile that has been calculated
+        self.live_values = None #the lightmap as it is being calculated (only while running)
+        
+        self.tiles_done = 0
+        self.started_at = None
+        self.cancelled = False
+    
+    def run(self, progress_callback = None, base = None):
+        'Calculate the lightmap, calling progress_callback(tiles done, total tiles, eta) as each tile is finished. Tiles are patched into base (an existing array of light levels) if it is given. Returns an array of light levels indexed [y, x], or None if cancelled'
+        self.tiles_done = 0
+        self.started_at = time.time()
+        
+        buffer, values = open_buffer(self.width, self.height)
+        if base is not None:
+            values[:, :] = base
+        self.live_values = values
+        
+        try:
+            pool = mp.Pool(self.workers, initializer = _init_worker, initargs = [buffer.name, self.width, self.height, self.renderer, self.map_data, self.materials, self.light_sources, self.blocking_panels, self.shadows, self.shadow_wedges])
+            
+            results = pool.imap_unordered(_calc_tile, self.tiles)
+            while self.tiles_done < len(self.tiles) and not self.cancelled:
+                try:
+                    box, blockers_hit = results.next(timeout = 0.1) #wake up regularly to check for cancellation
+                except mp.TimeoutError:
+                    pass
+                else:
+                    self.dependencies[tuple(box)] = {'box': box,
+                                                     'lights': [get_panel_key(source) for source in self.light_sources if light_reaches(source, get_sample_box(box, self.map_data), self.map_data, self.materials)],
+                                                     'blockers': [get_panel_key(self.blocking_panels[i]) for i in blockers_hit]}
+                    self.tiles_done += 1
+                    if progress_callback is not None:
+                        progress_callback(self.tiles_done, len(self.tiles), self.get_eta())
+            
+            if self.cancelled:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+            
+            if self.cancelled:
+                return None
+            else:
+                return values.copy()
+        
+        finally:
+            self.live_values = None
+            del values
+            buffer.close()
+            buffer.unlink()
+    
+    def cancel(self):
+        'Stop calculating the lightmap'
+        self.cancelled = True
+    
+    def get_record(self, previous = None):
+        'Make a record of what affected each tile of the lightmap, so that it can be updated incrementally later. Tiles that weren\'t recalculated are taken from the previous record'
+        tiles = {}
+        if previous is not None:
+            for tile in previous['tiles']:
+                tiles[tuple(tile['box'])] = tile
+        tiles.update(self.dependencies)
+        
+        return {'signature': get_signature(self.map_data, self.materials, self.shadows),
+                'lights': [get_panel_key(source) for source in self.light_sources],
+                'blockers': [get_panel_key(panel) for panel in self.blocking_panels],
+                'tiles': list(tiles.values())}
+    
+    def get_eta(self):
+        'Estimate how many seconds are left, based on how long the tiles so far have taken'
+        if self.tiles_done == 0:
+            return None
+        else:
+            return ((time.time() - self.started_at) / self.tiles_done) * (len(self.tiles) - self.tiles_done)
+
+
+class DynamicLightLayer:
+    """
+    Adds moving point lights (e.g. fireballs) on top of a baked lightmap at runtime. Only tiles near the lights are recalculated
+    """
+    def __init__(self, baked_values, origin, lighting, tile_size = 64):
+        self.origin = origin #world coordinates of the top left of the lightmap
+        self.lighting = lighting #the map's lighting config
+        
+        self.base_values = np.asarray(baked_values, dtype = np.float32) #kept in lightmap values (0-255) so that tiles without lights are drawn exactly as they were baked
+        height, width = self.base_values.shape
+        
+        self.tiles = []
+        for y0 in range(0, height, tile_size):
+            for x0 in range(0, width, tile_size):
+                self.tiles.append([x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)])
+        
+        self.lights = {}
+        self.drawn = [() for tile in self.tiles] #the lights that each tile was last drawn with
+        self.drawn_at = [0 for tile in self.tiles] #when each tile was last drawn, so that the oldest tiles are drawn first
+        self.frame = 0
+        
+        self.lock = threading.Lock()
+    
+    def set_light(self, key, x, y, emit, radius):
+        'Add or move a light. emit is the same as for materials. The light fades out to nothing at radius'
+        with self.lock:
+            self.lights[key] = (x, y, emit, radius)
+    
+    def remove_light(self, key):
+        with self.lock:
+            if key in self.lights:
+                self.lights.pop(key)
+    
+    def changed_tiles(self):
+        'Generate (tile index, RGBA array) for every tile that looks different to when it was last drawn, oldest first. Stop iterating when out of time - the rest will be given next time'
+        with self.lock:
+            lights = list(self.lights.values())
+        
+        self.frame += 1
+        
+        wanted = {}
+        for i, box in enumerate(self.tiles):
+            tile_lights = tuple([light for light in lights if self.light_touches(light, box)])
+            if tile_lights != self.drawn[i]:
+                wanted[i] = tile_lights
+        
+        for i in sorted(wanted, key = lambda i: self.drawn_at[i]):
+            self.drawn[i] = wanted[i]
+            self.drawn_at[i] = self.frame
+            yield i, values_to_rgba(self.render_tile(self.tiles[i], wanted[i]))
+    
+    def render_tile(self, box, lights):
+        'Calculate the light levels of a tile with some lights on top of the baked lightmap'
+        x0, y0, x1, y1 = box
+        values = self.base_values[y0:y1, x0:x1].copy()
+        
+        xs = np.arange(x0, x1, dtype = np.float32) + self.origin[0]
+        ys = np.arange(y0, y1, dtype = np.float32) + self.origin[1]
+        scale = pow(self.lighting['dist mult'], 4) #the baked lights multiply the distance by dist mult twice before squaring it
+        to_values = 255 / self.lighting['dynamic range']
+        
+        for light_x, light_y, emit, radius in lights:
+            dist_sq = np.square(xs - light_x)[np.newaxis, :] + np.square(ys - light_y)[:, np.newaxis]
+            
+            light = np.full(dist_sq.shape, emit, dtype = np.float32) #same falloff as the baked lights
+            np.divide(emit, dist_sq * scale, out = light, where = dist_sq != 0)
+            
+            fade = 1 - (np.sqrt(dist_sq) / radius)
+            np.clip(fade, 0, 1, out = fade)
+            values += light * fade * to_values
+        
+        return np.trunc(np.minimum(values, 255)).astype(np.uint8)
+    
+    def light_touches(self, light, box):
+        light_x, light_y, emit, radius = light
+        x = light_x - self.origin[0]
+        y = light_y - self.origin[1]
+        return math.hypot(max(box[0] - x, 0, x - box[2]), max(box[1] - y, 0, y - box[3])) < radius
+
+
+renderers = {'cells': CellCalc, 'numpy': VectorCalc}
+
+_worker = None #the buffer, array and calculator used by this worker process
+
+def _init_worker(buffer_name, width, height, renderer, map_data, materials, light_sources, blocking_panels, shadows, shadow_wedges):
+    global _worker
+    buffer, values = open_buffer(width, height, buffer_name)
+    _worker = [buffer, values, renderers[renderer](map_data, materials, light_sources, blocking_panels, shadows, shadow_wedges)]
+
+def _calc_tile(box):
+    return box, _worker[2].render_tile(_worker[1], box)
+
+
+def find_changed_tiles(record, map_data, materials, light_sources, blocking_panels, shadows = True):
+    'Use a record from TileScheduler.get_record to find the tiles that need to be recalculated after the layout has been edited. Returns None if the whole lightmap needs to be recalculated'
+    if record is None or not record['signature'] == get_signature(map_data, materials, shadows):
+        return None
+    
+    light_keys = [get_panel_key(source) for source in light_sources]
+    removed_lights = set(record['lights']).difference(light_keys)
+    added_lights = [source for source in light_sources if not get_panel_key(source) in record['lights']]
+    
+    removed_blockers = set(record['blockers']).difference([get_panel_key(panel) for panel in blocking_panels])
+    added_blockers = [panel for panel in blocking_panels if not get_panel_key(panel) in record['blockers']]
+    
+    changed = []
+    for tile in record['tiles']:
+        box = get_sample_box(tile['box'], map_data)
+        if not (removed_lights.isdisjoint(tile['lights']) and removed_blockers.isdisjoint(tile['blockers'])):
+            changed.append(tile['box'])
+        
+        elif True in [light_reaches(source, box, map_data, materials) for source in added_lights]:
+            changed.append(tile['box'])
+        
+        elif shadows and added_blockers != []:
+            #a new blocking panel can only cast a shadow on this tile if it is between the tile and a light
+            #every light is checked, as lots of lights that are out of reach can still add up to a visible difference together
+            for source in light_sources:
+                if True in [could_shadow(source['coordinates'], box, get_panel_box(panel, materials)) for panel in added_blockers]:
+                    changed.append(tile['box'])
+                    break
+    
+    return changed
+
+def get_signature(map_data, materials, shadows):
+    'Get everything other than the layout that affects the lightmap. If this changes, the whole lightmap has to be recalculated'
+    lighting = map_data['lighting'].copy()
+    lighting.pop('map', None)
+    
+    return json.loads(json.dumps({'geometry': map_data['geometry'],
+                                  'grid': map_data['grid'],
+                                  'lighting': lighting,
+                                  'shadows': shadows,
+                                  'materials': {name: [materials[name]['light'], materials[name]['hitbox']] for name in materials}}, sort_keys = True))
+
+def get_panel_key(panel):
+    'Get a string that identifies a panel in the layout'
+    return '{}@{},{}'.format(panel['material'], *panel['coordinates'])
+
+def get_panel_box(panel, materials):
+    'Get the bounding box of a panel\'s hitbox'
+    xs = [x + panel['coordinates'][0] for x, y in materials[panel['material']]['hitbox']]
+    ys = [y + panel['coordinates'][1] for x, y in materials[panel['material']]['hitbox']]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def could_shadow(light, box, blocker_box):
+    'Find whether a blocker (given as a bounding box) could be on any line between a light and a box. Every one of these lines is inside the convex hull of the light and the box\'s corners'
+    hull = get_convex_hull([light, [box[0], box[1]], [box[2], box[1]], [box[2], box[3]], [box[0], box[3]]])
+    blocker = [[blocker_box[0], blocker_box[1]], [blocker_box[2], blocker_box[1]], [blocker_box[2], blocker_box[3]], [blocker_box[0], blocker_box[3]]]
+    
+    #separating axis test - the shapes don't overlap if there is a line that they are on different sides of
+    axes = [[1, 0], [0, 1]]
+    for i in range(len(hull)):
+        axes.append([hull[i][1] - hull[i - 1][1], hull[i - 1][0] - hull[i][0]])
+    
+    for axis_x, axis_y in axes:
+        hull_proj = [(x * axis_x) + (y * axis_y) for x, y in hull]
+        blocker_proj = [(x * axis_x) + (y * axis_y) for x, y in blocker]
+        if max(hull_proj) < min(blocker_proj) or max(blocker_proj) < min(hull_proj):
+            return False
+    return True
+
+def get_convex_hull(points):
+    'Find the convex hull of some points (monotone chain)'
+    points = sorted(set([tuple(point) for point in points]))
+    if len(points) < 3:
+        return points
+    
+    def cross(o, a, b):
+        return ((a[0] - o[0]) * (b[1] - o[1])) - ((a[1] - o[1]) * (b[0] - o[0]))
+    
+    lower = []
+    upper = []
+    for point in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], point) <= 0:
+            lower.pop()
+        lower.append(point)
+    for point in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], point) <= 0:
+            upper.pop()
+        upper.append(point)
+    return lower[:-1] + upper[:-1]
+
+def get_light_reach(emit, map_data):
+    'Find how far away from a light it stops changing the lightmap by at least one level'
+    dist_mult = map_data['lighting']['dist mult']
+    if dist_mult == 0:
+        return math.inf
+    else:
+        return math.sqrt(emit * 255 / map_data['lighting']['dynamic range']) / pow(dist_mult, 2)
+
+def light_reaches(source, box, map_data, materials):
+    'Find whether a light is close enough to any part of a box to change its light level'
+    x, y = source['coordinates']
+    distance = math.hypot(max(box[0] - x, 0, x - box[2]), max(box[1] - y, 0, y - box[3]))
+    return distance <= get_light_reach(materials[source['material']]['light']['emit'], map_data)
+
+
+def make_tiles(width, height, xinc, yinc, tile_size):
+    'Split a lightmap into boxes ([x0, y0, x1, y1]) that line up with the cell grid'
+    tile_width = max(1, round(tile_size / xinc)) * xinc
+    tile_height = max(1, round(tile_size / yinc)) * yinc
+    
+    tiles = []
+    for y0 in range(1, height, tile_height):
+        for x0 in range(1, width, tile_width):
+            tiles.append([x0, y0, min(x0 + tile_width, width), min(y0 + tile_height, height)])
+    return tiles
+
+class OccluderGrid:
+    """
+    A uniform grid of the bounding boxes of the blocking panels, so that a line only has to be tested against the panels in the grid squares it passes through
+    """
+    def __init__(self, boxes, cell_size = 64):
+        self.boxes = boxes
+        self.cell_size = cell_size
+        
+        self.cells = {}
+        for i, box in enumerate(self.boxes):
+            for cell_x in range(math.floor((box[0] - 1) / self.cell_size), math.floor((box[2] + 1) / self.cell_size) + 1):
+                for cell_y in range(math.floor((box[1] - 1) / self.cell_size), math.floor((box[3] + 1) / self.cell_size) + 1):
+                    if (cell_x, cell_y) in self.cells:
+                        self.cells[(cell_x, cell_y)].append(i)
+                    else:
+                        self.cells[(cell_x, cell_y)] = [i]
+    
+    def query(self, x0, y0, x1, y1):
+        'Get the indexes of the boxes that a line could pass through, in the order they were given'
+        found = set()
+        for cell in self.walk(x0, y0, x1, y1):
+            if cell in self.cells:
+                found.update(self.cells[cell])
+        
+        return [i for i in sorted(found) if line_hits_box(x0, y0, x1, y1, self.boxes[i])]
+    
+    def walk(self, x0, y0, x1, y1):
+        'Get the grid squares that a line passes through'
+        cell_x = math.floor(x0 / self.cell_size)
+        cell_y = math.floor(y0 / self.cell_size)
+        end_x = math.floor(x1 / self.cell_size)
+        end_y = math.floor(y1 / self.cell_size)
+        
+        dx = x1 - x0
+        dy = y1 - y0
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        
+        #how far along the line the next grid line is crossed, and how far along the line each grid square is
+        if dx == 0:
+            next_x = math.inf
+            delta_x = math.inf
+        else:
+            next_x = (((cell_x + (step_x > 0)) * self.cell_size) - x0) / dx
+            delta_x = self.cell_size / abs(dx)
+        
+        if dy == 0:
+            next_y = math.inf
+            delta_y = math.inf
+        else:
+            next_y = (((cell_y + (step_y > 0)) * self.cell_size) - y0) / dy
+            delta_y = self.cell_size / abs(dy)
+        
+        cells = [(cell_x, cell_y)]
+        for i in range(abs(end_x - cell_x) + abs(end_y - cell_y)):
+            if next_x < next_y:
+                cell_x += step_x
+                next_x += delta_x
+            else:
+                cell_y += step_y
+                next_y += delta_y
+            cells.append((cell_x, cell_y))
+        return cells
+
+
+def line_hits_box(x0, y0, x1, y1, box, margin = 1):
+    'Find whether a line could touch a box (made slightly bigger by margin), using the slab method'
+    t_min = 0
+    t_max = 1
+    for start, delta, low, high in [[x0, x1 - x0, box[0] - margin, box[2] + margin], [y0, y1 - y0, box[1] - margin, box[3] + margin]]:
+        if delta == 0:
+            if start < low or start > high:
+                return False
+        else:
+            t0 = (low - start) / delta
+            t1 = (high - start) / delta
+            t_min = max(t_min, min(t0, t1))
+            t_max = min(t_max, max(t0, t1))
+            if t_min > t_max:
+                return False
+    return True
+
+def get_shadow_wedge(light, box, margin = 1):
+    'Find the range of angles (around the centre of the box) and the minimum distance from a light at which a box could block it. Returns None if the light is inside the box'
+    x, y = light
+    box = [box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin]
+    
+    if box[0] <= x <= box[2] and box[1] <= y <= box[3]:
+        return None
+    
+    centre = math.atan2(((box[1] + box[3]) / 2) - y, ((box[0] + box[2]) / 2) - x)
+    offsets = [wrap_angle(math.atan2(corner_y - y, corner_x - x) - centre) for corner_x, corner_y in [[box[0], box[1]], [box[2], box[1]], [box[2], box[3]], [box[0], box[3]]]]
+    near = math.hypot(max(box[0] - x, 0, x - box[2]), max(box[1] - y, 0, y - box[3]))
+    
+    return [centre, min(offsets) - 1e-9, max(offsets) + 1e-9, near - 1e-9]
+
+def in_wedge(wedge, angle, length):
+    'Find whether points (at angles and distances from a light) are inside a shadow wedge. Works on numbers and NumPy arrays'
+    if wedge is None:
+        return True | (length < 0) #always inside, with the same type as length
+    
+    centre, min_offset, max_offset, near = wedge
+    offset = wrap_angle(angle - centre)
+    return (offset >= min_offset) & (offset <= max_offset) & (length >= near)
+
+def wrap_angle(angle):
+    'Wrap an angle into the range -pi to pi'
+    return ((angle + math.pi) % (2 * math.pi)) - math.pi
+
+legacy_strips = 8 #number of strips the old baker split the map into (it always waited for 8 processes to finish)
+
+def get_cell_size(map_data):
+    'Find the size of the cells that the lightmap is calculated in'
+    if map_data['grid']['apply to lightmap']:
+        return map_data['grid']['mult']['x'], map_data['grid']['mult']['y']
+    else:
+        return 1, 1
+
+def get_column_cells(xs, width, xinc):
+    """
+    Find the start of the cell that each column of pixels is in
+    
+    The old lightmap baker split the map into legacy_strips strips and gave each one its own cell grid, starting at the strip's left edge (or 1 for the first strip). Columns use the same cells so that rebaking a map doesn't change its lighting. Rows all use one grid starting at 1, as they always have
+    """
+    xs = np.asarray(xs)
+    strip_width = max(1, int(width / legacy_strips))
+    strip_starts = np.maximum(1, (xs // strip_width) * strip_width)
+    return strip_starts + (((xs - strip_starts) // xinc) * xinc)
+
+def get_sample_box(box, map_data):
+    'Get a box that contains every point sampled for the pixels in a box - a cell can be sampled from just past the edge of the box'
+    xinc, yinc = get_cell_size(map_data)
+    return [box[0], box[1], box[2] + xinc, box[3] + yinc]
+
+def get_sample_coords(start, stop, increment):
+    'Find the start of each cell in a range and the coordinate that its light level is sampled at. If stop is None, start is an array of cell starts'
+    if stop is None:
+        starts = np.asarray(start)
+    else:
+        starts = np.arange(start, stop, increment)
+    return starts, ((starts / increment).astype(int) + 1) * increment
+
+def upscale_bilinear(cells, cell_xs, cell_ys, xs, ys):
+    'Bilinearly interpolate an array of cell values (with centres at cell_xs and cell_ys) onto the points xs and ys. Returns an array indexed [y, x]'
+    x_index, x_weight = get_interp_weights(cell_xs, xs)
+    y_index, y_weight = get_interp_weights(cell_ys, ys)
+    
+    cells = np.asarray(cells, dtype = float)
+    if cells.shape[1] > 1:
+        cells = (cells[:, x_index] * (1 - x_weight)) + (cells[:, x_index + 1] * x_weight)
+    else:
+        cells = cells[:, x_index]
+    
+    if cells.shape[0] > 1:
+        cells = (cells[y_index] * (1 - y_weight)[:, np.newaxis]) + (cells[y_index + 1] * y_weight[:, np.newaxis])
+    else:
+        cells = cells[y_index]
+    
+    return np.clip(np.round(cells), 0, 255).astype(np.uint8)
+
+def get_interp_weights(samples, points):
+    'For each point, find the sample before it and how far it is towards the next sample (clamped at the ends)'
+    if len(samples) < 2:
+        return np.zeros(len(points), dtype = int), np.zeros(len(points))
+    
+    position = np.interp(points, samples, np.arange(len(samples)))
+    index = np.minimum(position.astype(int), len(samples) - 2)
+    return index, position - index
+
+def get_occluder_edges(panel, materials):
+    'Get the edges of a panel\'s hitbox in the order that CellCalc.line_passes_through tests them'
+    hitbox = [[x + panel['coordinates'][0], y + panel['coordinates'][1]] for x, y in materials[panel['material']]['hitbox']]
+    
+    edges = []
+    for i in range(1, len(hitbox)):
+        if i == len(hitbox) - 1: #the last edge is tested from the first point
+            edges.append([hitbox[0], hitbox[i]])
+        else:
+            edges.append([hitbox[i - 1], hitbox[i]])
+    return edges
+
+def open_buffer(width, height, name = None):
+    'Open a lightmap buffer in shared memory (creating a new one if no name is given). Returns the shared memory object and an array of light levels indexed [y, x] that uses it'
+    if name is None:
+        buffer = shared_memory.SharedMemory(create = True, size = width * height)
+    else:
+        buffer = shared_memory.SharedMemory(name = name)
+    
+    values = np.ndarray((height, width), dtype = np.uint8, buffer = buffer.buf)
+    if name is None:
+        values.fill(0)
+    return buffer, values
+
+def rgba_to_values(rgba):
+    'Turn RGBA pixel data from a lightmap image back into an array of light levels'
+    return 255 - np.asarray(rgba, dtype = np.uint8)[:, :, 3]
+
+def values_to_rgba(values):
+    'Turn an array of light levels into RGBA pixel data for the lightmap image (black, with the darkest areas being the most opaque)'
+    rgba = np.zeros(values.shape + (4,), dtype = np.uint8)
+    rgba[:, :, 3] = 255 - np.clip(values, 0, 255)
+    return rgba
\ No newline at end of file
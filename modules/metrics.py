@@ -0,0 +1,171 @@
+import http.server
+import threading
+import bisect
+
+class Counter:
+    'A value that only goes up'
+    kind = 'counter'
+    
+    def __init__(self):
+        self.value = 0
+    
+    def inc(self, amount = 1):
+        self.value += amount
+    
+    def get_samples(self):
+        return [['', self.value]]
+
+
+class Gauge:
+    'A value that can go up or down. If a function is given, it is called to get the value whenever the gauge is read'
+    kind = 'gauge'
+    
+    def __init__(self, func = None):
+        self.value = 0
+        self.func = func
+    
+    def set(self, value):
+        self.value = value
+    
+    def get_samples(self):
+        if self.func is None:
+            return [['', self.value]]
+        else:
+            return [['', self.func()]]
+
+
+class Histogram:
+    'Counts observations in buckets (upper bounds, in ascending order)'
+    kind = 'histogram'
+    default_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+    
+    def __init__(self, buckets = None):
+        if buckets is None:
+            buckets = self.default_buckets
+        
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) #last one is for observations above every bucket
+        self.sum = 0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def get_samples(self):
+        output = []
+        total = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            output.append(['_bucket{{le="{}"}}'.format(bound), total])
+        output.append(['_sum', self.sum])
+        output.append(['_count', self.count])
+        return output
+
+
+class Registry:
+    """
+    Holds every metric for a server. Metrics are made (or fetched, if they already exist) by name and labels, and are updated directly so recording costs an attribute change
+    
+    Updates aren't locked, so a value read while it is being changed from another thread can be off by one update
+    """
+    def __init__(self):
+        self._metrics = {} #(name, labels): metric
+        self._help = {} #name: help text
+        self._lock = threading.Lock()
+        
+        self._http_server = None
+    
+    def counter(self, name, help_text = '', labels = None):
+        return self._get(Counter, name, help_text, labels)
+    
+    def gauge(self, name, help_text = '', labels = None, func = None):
+        return self._get(Gauge, name, help_text, labels, func)
+    
+    def histogram(self, name, help_text = '', labels = None, buckets = None):
+        return self._get(Histogram, name, help_text, labels, buckets)
+    
+    def _get(self, metric_type, name, help_text, labels, *args):
+        if labels is None:
+            labels = {}
+        key = (name, tuple(sorted([(str(label), str(value)) for label, value in labels.items()])))
+        
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = metric_type(*args)
+                self._help[name] = help_text
+            
+            elif type(self._metrics[key]) is not metric_type:
+                raise TypeError('Metric "{}" is a {}, not a {}'.format(name, self._metrics[key].kind, metric_type.kind))
+            
+            return self._metrics[key]
+    
+    def remove(self, name, labels = None):
+        'Stop reporting a metric (e.g. a gauge that reads from something that no longer exists)'
+        if labels is None:
+            labels = {}
+        
+        with self._lock:
+            self._metrics.pop((name, tuple(sorted([(str(label), str(value)) for label, value in labels.items()]))), None)
+    
+    def format_text(self, labels = None):
+        'Get every metric in the Prometheus text format. If labels is given, only metrics with all of these labels are included'
+        if labels is None:
+            labels = {}
+        wanted = set([(str(label), str(value)) for label, value in labels.items()])
+        
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        
+        lines = []
+        last_name = None
+        for (name, metric_labels), metric in metrics:
+            if not wanted.issubset(metric_labels):
+                continue
+            
+            if name != last_name:
+                if self._help[name] != '':
+                    lines.append('# HELP {} {}'.format(name, self._help[name]))
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+                last_name = name
+            
+            for suffix, value in metric.get_samples():
+                sample_labels = ['{}="{}"'.format(label, label_value) for label, label_value in metric_labels]
+                
+                if suffix.startswith('_bucket'): #bucket label is already in the suffix
+                    suffix, bucket_label = suffix[:-1].split('{')
+                    sample_labels.append(bucket_label)
+                
+                if len(sample_labels) == 0:
+                    lines.append('{}{} {}'.format(name, suffix, value))
+                else:
+                    lines.append('{}{}{{{}}} {}'.format(name, suffix, ','.join(sample_labels), value))
+        
+        return lines
+    
+    def serve(self, port, host = '127.0.0.1'):
+        'Serve the metrics as plain text over HTTP from a daemon thread'
+        registry = self
+        
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = '\n'.join(registry.format_text() + ['']).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._http_server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        self._http_server.daemon_threads = True
+        threading.Thread(target = self._http_server.serve_forever, name = 'Metrics HTTP server', daemon = True).start()
+    
+    def stop_serving(self):
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
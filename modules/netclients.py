@@ -1,4 +1,3 @@
-from tkinter import messagebox
 import socket
 import threading
 import json
@@ -6,9 +5,12 @@ import random
 import time
 
 from modules.networking import Request
+import modules.servertrace
 
 class Client:
     def __init__(self, server_data, ui):
+        from tkinter import messagebox #only the game client uses Tk, so importing this module doesn't import tkinter on a headless server
+        
         class serverdata:
             raw = server_data
             host = raw['address']
@@ -101,20 +103,26 @@ class NetClient:
         
         self.listener = SocketListen(self)
         self._log = None
+        self.on_traffic = None #called with (kind, bytes, command, subcommand) for every request sent
         
         self.running = False
     
     def start(self):
-        self.running = True
-        
-        self.listener.listen()
+        if not self.running: #joining a lobby starts the client again, and a second listener would split the stream
+            self.running = True
+            
+            self.listener.listen()
     
     def send(self, req):
         self.send_to(self.connection, req)
     
     def send_to(self, connection, req):
         try:
-            connection.send(req.as_json().encode())
+            data = req.as_json().encode()
+            connection.send(data)
+            
+            if self.on_traffic is not None:
+                self.on_traffic(modules.servertrace.KIND_SEND, len(data), req.command, req.subcommand)
         except OSError:
             if self._log is not None:
                 self._log.add('sending', 'Couldn\'t send request: {}'.format(req.pretty_print()))
@@ -129,6 +137,7 @@ class SocketListen:
         
         self.binds = []
         self.running = False
+        self.on_traffic = None #called with (kind, bytes, command, subcommand) for every request received
     
     def listen(self):
         self.running = True
@@ -149,6 +158,10 @@ class SocketListen:
                 if type(data) is not str:
                     print(data)
                 
+                if data == '': #the other end closed the connection - recv won't block again, so stop listening
+                    reqs.append(Request(command = 'disconnect', arguments = {'clean': False}))
+                    self.running = False
+                
                 #unpack the data - often will get multiple dictionaries
                 for char in data:
                     if char == '{' and not is_escaped and not is_string:
@@ -174,7 +187,13 @@ class SocketListen:
                 for json_data in output:
                     reqs.append(Request(json_data))
                     
-            except (ConnectionResetError, ConnectionAbortedError):
+                    if self.on_traffic is not None:
+                        self.on_traffic(modules.servertrace.KIND_RECV, len(json_data.encode()), reqs[-1].command, reqs[-1].subcommand)
+                    
+                    if reqs[-1].command == 'disconnect': #the other end won't send anything else, so don't report it closing the connection as an unclean disconnect
+                        self.running = False
+                    
+            except OSError:
                 reqs.append(Request(command = 'disconnect', arguments = {'clean': False})) #argument 'clean' shows whether or not a message was sent to close the connection or the conenction was forcibly closed
                 self.running = False
             
@@ -195,6 +214,12 @@ class ServerClient:
         
         self.interface.listener.binds.append(self.handle)
         
+        #bytes and requests counters for each direction
+        self._traffic_metrics = {modules.servertrace.KIND_SEND: [self.server.metrics.counter('network_bytes_total', 'Bytes sent or received by server clients', {'direction': 'out'}),
+                                                                 self.server.metrics.counter('network_requests_total', 'Requests sent or received by server clients', {'direction': 'out'})],
+                                 modules.servertrace.KIND_RECV: [self.server.metrics.counter('network_bytes_total', 'Bytes sent or received by server clients', {'direction': 'in'}),
+                                                                 self.server.metrics.counter('network_requests_total', 'Requests sent or received by server clients', {'direction': 'in'})]}
+        
         class metadata:
             model = None
             mode = None
@@ -391,7 +416,7 @@ class ServerClient:
         
             elif req.command == 'db read':
                 if req.subcommand == 'leaderboard':
-                    self.send(Request(command = 'db read response', subcommand = 'leaderboard', arguments = {'data': self.server.database.get_leaderboard(req.arguments['num'])}))
+                    self.send(Request(command = 'db read response', subcommand = 'leaderboard', arguments = {'data': self.server.database.get_leaderboard(req.arguments['num'], req.arguments.get('offset', 0))}))
             
             elif req.command == 'db write':
                 pass
@@ -443,16 +468,18 @@ class ServerClient:
                 
                 self.client_display_text(['fullscreen', 'welcome'], None, category = 'welcome')
                 
-            elif req.command == 'use' and req.arguments['item'] in self.lobby.items.dicts:
-                if self.metadata.item_use_timestamp is None or (time.time() - self.metadata.item_use_timestamp) > self.lobby.items.dicts[req.arguments['item']]['use cooldown']:
-                    obj = self.lobby.items.scripts[self.lobby.items.dicts[req.arguments['item']]['control script']](req.arguments['item'], self.lobby)
+            elif req.command == 'use' and req.arguments['item'] in self.lobby.items.definitions:
+                definition = self.lobby.items.definitions[req.arguments['item']]
+                
+                if self.metadata.item_use_timestamp is None or (time.time() - self.metadata.item_use_timestamp) > definition.use_cooldown:
+                    obj = definition.script(req.arguments['item'], self.lobby)
                     
                     obj.attributes.creator = self
                     obj.attributes.pos.x = req.arguments['position'][0]
                     obj.attributes.pos.y = req.arguments['position'][1]
                     obj.attributes.rotation = req.arguments['rotation']
                     obj.attributes.ticket = self.lobby.items.ticket
-                    obj.set_velocity(self.lobby.items.dicts[req.arguments['item']]['speed'])
+                    obj.set_velocity(definition.speed)
                     
                     self.lobby.items.objects.append(obj)
                     
@@ -466,6 +493,18 @@ class ServerClient:
             elif req.command == 'say':
                 self.send_all(Request(command = 'say', arguments = {'text': '{}: {}'.format(self.metadata.username, req.arguments['text'])}))
     
+    def record_traffic(self, kind, num_bytes, command, subcommand):
+        if self.lobby is None:
+            lobby_index = -1
+        else:
+            lobby_index = self.lobby.index
+        
+        self.server.trace.net(kind, lobby_index, self.metadata.id, num_bytes, command, subcommand)
+        
+        bytes_counter, requests_counter = self._traffic_metrics[kind]
+        bytes_counter.inc(num_bytes)
+        requests_counter.inc()
+    
     def close(self):
         self.metadata.active = False
         self.interface.close()
\ No newline at end of file
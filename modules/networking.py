@@ -8,14 +8,18 @@ import random
 import time
 import math
 
-import modules.servercmds
 import modules.quicklogs
 import modules.netclients
 import modules.modloader
 import modules.dbaccess
+import modules.servertrace
+import modules.metrics
+import modules.config
+import modules.items
+import modules.streamcmds
 
 class Server:
-    def __init__(self, port_, frame = None):
+    def __init__(self, port_, frame = None, headless = False):
         class serverdata:
             host = '' #hostname of server
             port = port_ #port server is operating on
@@ -28,16 +32,30 @@ class Server:
         self.clients = []
         
         self.frame = frame
+        self.headless = headless #use stdin and stdout for the consoles instead of Tk windows
         
-        self.log = modules.quicklogs.Log(os.path.join(sys.path[0], 'server', 'logs', 'svlog.txt'))
+        self.settingsdata = modules.config.service.get('server')
         
-        self.database = modules.dbaccess.ServerDatabase(os.path.join(sys.path[0], 'server', 'database.db'), modules.quicklogs.Log(os.path.join(sys.path[0], 'server', 'logs', 'dblog.txt')))
+        self.log = modules.quicklogs.Log.from_config(os.path.join(sys.path[0], 'server', 'logs', 'svlog.txt'), self.settingsdata.get('logs', {}))
+        
+        self.trace = modules.servertrace.TraceRecorder(self.settingsdata.get('trace', {}).get('capacity', 65536), self.settingsdata.get('trace', {}).get('enabled', True))
+        
+        self.database_log = modules.quicklogs.Log.from_config(os.path.join(sys.path[0], 'server', 'logs', 'dblog.txt'), self.settingsdata.get('logs', {}))
+        self.database = modules.dbaccess.ServerDatabase(os.path.join(sys.path[0], 'server', 'database.db'), self.database_log)
 
+        self.metrics = modules.metrics.Registry()
+        self.metrics.gauge('server_clients', 'Clients connected to the server', func = lambda: len(self.clients))
+        self.metrics.gauge('server_lobbies', 'Lobbies on the server', func = lambda: len(self.lobbies))
+        self.metrics.gauge('database_queue_depth', 'Database operations waiting for the database daemon', func = self.database.get_queue_depth)
+        self.metrics.gauge('log_queue_depth', 'Log entries waiting to be written', func = self.log.get_queue_depth)
+        self.metrics.gauge('process_cpu_seconds', 'CPU time used by the server process', func = time.process_time)
+        self._connections_counter = self.metrics.counter('server_connections_total', 'Connections accepted by the server')
+        
+        if self.settingsdata.get('metrics', {}).get('serve http', False):
+            self.metrics.serve(self.settingsdata['metrics'].get('http port', 9321))
+        
         self.output_pipe, pipe = mp.Pipe()
-        self.cmdline = modules.servercmds.ServerCommandLineUI(self.handle_command, pipe, self.frame)
-
-        with open(os.path.join(sys.path[0], 'server', 'config.json'), 'r') as file:
-            self.settingsdata = json.load(file)
+        self.cmdline = self.make_command_line(self.handle_command, pipe, self.frame)
         
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connection.bind((self.serverdata.host, self.serverdata.port))
@@ -67,9 +85,12 @@ class Server:
                 client = modules.netclients.ServerClient(self, netcl, None)
                 client.metadata.id = current_id
                 current_id += 1
+                netcl.on_traffic = client.record_traffic
+                netcl.listener.on_traffic = client.record_traffic
                 netcl.start()
 
                 self.clients.append(client)
+                self._connections_counter.inc()
 
                 for script_name in self.settingsdata['scripts']['server']['userconnect']:
                     with open(os.path.join(sys.path[0], 'server', 'scripts', '{}.txt'.format(script_name)), 'r') as file:
@@ -113,6 +134,8 @@ sv_:
 sv_conns: list of connections to the server
 sv_kick_addr: kick a player by address
 sv_quit: destroy the server
+sv_trace_dump: save the tick and network trace to a file (default server/logs/trace.bin)
+sv_metrics: show the server's metrics
 
 lby_:
 lby_create: make a new lobby
@@ -121,7 +144,8 @@ lby_quit: Quit a lobby given its index
 
 db_:
 db_commit: push all database changes to the disk
-db_reset: resets the database''')
+db_reset: resets the database
+db_stats: show the number of calls and latency of each database operation''')
         
         elif operation == 'exec':
             with open(os.path.join(sys.path[0], 'server', 'scripts', '{}.txt'.format(argument)), 'r') as file:
@@ -160,6 +184,15 @@ db_reset: resets the database''')
         elif operation == 'sv_quit':
             self.quit()
         
+        elif operation == 'sv_metrics':
+            output += self.metrics.format_text()
+        
+        elif operation == 'sv_trace_dump':
+            if argument == '':
+                argument = os.path.join(sys.path[0], 'server', 'logs', 'trace.bin')
+            
+            output.append('Saved {} trace record(s) to {}'.format(self.trace.dump(argument), argument))
+        
         elif operation == 'lby_create':
             self.make_new_lobby()
         
@@ -188,12 +221,24 @@ db_reset: resets the database''')
         elif operation == 'db_reset':
             self.database.make()
         
+        elif operation == 'db_stats':
+            output += self.database.format_stats()
+        
         return output
     
     def run_script(self, text):
         for line in text.split('\n'):
             self.output_pipe.send(self.handle_command(line))
     
+    def make_command_line(self, command_handler, pipe, frame = None):
+        'Make a console for the server or a lobby - a Tk window, or stdin and stdout if the server is headless'
+        if self.headless:
+            return modules.streamcmds.StreamCommandLine(command_handler, pipe)
+        
+        else:
+            import modules.servercmds as servercmds #imports tkinter, so a headless server never imports it
+            return servercmds.ServerCommandLineUI(command_handler, pipe, frame)
+    
     def console_output(self, data):
         if type(data) == list:
             for line in data:
@@ -207,6 +252,9 @@ db_reset: resets the database''')
         self.serverdata.running = False
         self.connection.close()
         self.database.close()
+        self.metrics.stop_serving()
+        self.database_log.close()
+        self.log.close()
 
     #lobby methods
     def make_new_lobby(self):
@@ -237,6 +285,7 @@ class Lobby:
     def __init__(self, server, log, frame = None):
         self.server = server
         self.log = log
+        self.index = len(self.server.lobbies) #lobbies are never removed from the server's list, so this is its index there
 
         #define attribute structure
         class cfgs:
@@ -247,6 +296,7 @@ class Lobby:
             objects = []
             dicts = {}
             scripts = {}
+            definitions = {} #item file name: modules.items.ItemDefinition
             ticket = 0
         self.items = items
 
@@ -274,15 +324,14 @@ class Lobby:
         self.running = True
 
         #load configs
-        with open(os.path.join(sys.path[0], 'server', 'config.json'), 'r') as file:
-            self.cfgs.server = json.load(file)
+        self.cfgs.server = modules.config.service.get('server')
         
         #put config into data structure
         self.tickrate = self.cfgs.server['network']['tickrate']
 
         #load components
         self.cmdline_pipe, pipe = mp.Pipe()
-        self.cmdline = modules.servercmds.ServerCommandLineUI(self.handle_command, pipe, frame)
+        self.cmdline = self.server.make_command_line(self.handle_command, pipe, frame)
         self.cmdline.set_title('Lobby Command Line')
 
         #run autoexec
@@ -297,6 +346,14 @@ class Lobby:
         self.current_round.start_time = time.time()
         self.current_round.in_progress = True
 
+        #metrics
+        metric_labels = {'lobby': self.index}
+        self.server.metrics.gauge('lobby_players', 'Active players in the lobby', metric_labels, func = lambda: self.num_players)
+        self.server.metrics.gauge('lobby_items', 'Items in the lobby', metric_labels, func = lambda: len(self.items.objects))
+        self._tick_histogram = self.server.metrics.histogram('lobby_tick_seconds', 'Time taken by each lobby tick', metric_labels)
+        self._overrun_counter = self.server.metrics.counter('lobby_tick_overruns_total', 'Ticks that took longer than the tick interval', metric_labels)
+        self._item_states_counter = self.server.metrics.counter('lobby_item_states_total', 'Item states pushed to clients', metric_labels)
+
         #start threads
         threading.Thread(target = self._roundtimerd, name = 'Round timer daemon', daemon = True).start()
         threading.Thread(target = self._itemhandlerd, name = 'Item handler daemon', daemon = True).start()
@@ -365,11 +422,13 @@ sv_:
 sv_kick_addr: kick a player by address
 
 lby_hitbox: choose whether or not to use accurate hitboxes
+lby_metrics: show this lobby's metrics
 lby_quit: close the lobby
 
 db_:
 db_commit: push all database changes to the disk
-db_reset: resets the database''')
+db_reset: resets the database
+db_stats: show the number of calls and latency of each database operation''')
         
         elif operation == 'map':
             try:
@@ -455,6 +514,9 @@ db_reset: resets the database''')
         elif operation == 'lby_quit':
             self.close()
         
+        elif operation == 'lby_metrics':
+            output += self.server.metrics.format_text({'lobby': self.index})
+        
         elif operation == 'lby_hitbox':
             try:
                 for client in self.server.clients:
@@ -469,6 +531,9 @@ db_reset: resets the database''')
         elif operation == 'db_reset':
             self.server.database.make()
         
+        elif operation == 'db_stats':
+            output += self.server.database.format_stats()
+        
         return output
     
     def load_map(self, map_name):
@@ -486,18 +551,25 @@ db_reset: resets the database''')
                 client.give(self.map.data['player']['starting items'][client.metadata.team_id])
                 client.metadata.model = random.choice(self.map.data['entity models']['player'])
 
-        self.items.dicts = {}
+        dicts = {}
         for item_name in os.listdir(os.path.join(sys.path[0], 'server', 'maps', self.map.name, 'items')):
             if item_name.endswith('.json'):
                 with open(os.path.join(sys.path[0], 'server', 'maps', self.map.name, 'items', item_name), 'r') as file:
-                    self.items.dicts[item_name] = json.load(file)
+                    dicts[item_name] = json.load(file)
         
         self.map.script_loader = modules.modloader.ModLoader(os.path.join(sys.path[0], 'server', 'maps', self.map.name, 'items'))
 
-        scripts = self.map.script_loader.load('ItemScript')
-        self.items.scripts = {}
-        for script_obj in scripts:
-            self.items.scripts[script_obj.internal_name] = script_obj
+        scripts = {}
+        for script_obj in self.map.script_loader.load('ItemScript'):
+            scripts[script_obj.internal_name] = script_obj
+        
+        #compile everything items need once, so that using an item during a match is only in-memory work
+        definitions = {}
+        for item_name, item_cfg in dicts.items():
+            definitions[item_name] = modules.items.ItemDefinition(item_name, item_cfg, scripts[item_cfg['control script']])
+        
+        #replace all at once so that the socket threads never see a mix of maps
+        self.items.dicts, self.items.scripts, self.items.definitions = dicts, scripts, definitions
     
     def console_output(self, s):
         self.cmdline_pipe.send(s)
@@ -507,8 +579,8 @@ db_reset: resets the database''')
         for item in path:
             string = string[item]
         
-        if type(string) == list:
-            string = random.choice(list)
+        if type(string) in [list, tuple]:
+            string = random.choice(string)
         
         if not type(string) == str:
             raise ValueError('Invalid string path {} - doesn\'t give a string'.format(path))
@@ -585,14 +657,19 @@ db_reset: resets the database''')
     def round_ended(self, winner = None):
         self.current_round.in_progress = False
         
-        for client in self.clients:
-            if client.metadata.active:
-                self.server.database.add_user(client.metadata.username)
-
-                if winner is None or not client.metadata.team_id == winner:
-                    self.server.database.increment_user(client.metadata.username, losses = 1)
-                else:
-                    self.server.database.increment_user(client.metadata.username, wins = 1)
+        #the scoreline is only updated by the round end handlers, so add this round's point to the recorded scores here
+        scores = list(self.scoreline)
+        if winner is not None:
+            scores[winner] += 1
+        
+        #the database daemon records the match and works out the new ratings, so this thread only has to queue it
+        self.server.database.match_concluded({'map': self.map.name,
+                                              'gamemode': self.gamemode,
+                                              'started': self.current_round.start_time,
+                                              'duration': time.time() - self.current_round.start_time,
+                                              'winner': winner,
+                                              'scores': scores,
+                                              'players': [{'username': client.metadata.username, 'team': client.metadata.team_id} for client in self.clients if client.metadata.active]})
         
         if self.gamemode == 0:
             self.xvx_round_ended(winner = winner)
@@ -688,13 +765,19 @@ db_reset: resets the database''')
         self.send_text(['fullscreen', 'lobby', 'stopped'], category = 'lobby')
 
         self.running = False
+        
+        #the gauges read from this lobby, so stop reporting them (and the rest of its metrics) once it has closed
+        for name in ['lobby_players', 'lobby_items', 'lobby_tick_seconds', 'lobby_tick_overruns_total', 'lobby_item_states_total']:
+            self.server.metrics.remove(name, {'lobby': self.index})
     
     #daemons
     def _itemhandlerd(self):
         delayed_handles = {}
+        tick_num = 0
         
         while self.running:
             loop_start = time.time()
+            phase_start = time.perf_counter()
 
             ####
             items_to_remove = [] #can't change length during iteration, have to use this ugly workaround
@@ -745,9 +828,19 @@ db_reset: resets the database''')
                 self.items.objects.pop(i)
             
             #push new item states to clients
+            push_start = time.perf_counter()
             for client in self.clients:
                 client.push_item_states(item_states)
                 client.push_positions()
+            
+            tick_end = time.perf_counter()
+            self.server.trace.tick(self.index, tick_num, push_start - phase_start, tick_end - push_start, len(self.items.objects), len(self.clients))
+            tick_num += 1
+            
+            self._tick_histogram.observe(tick_end - phase_start)
+            self._item_states_counter.inc(len(item_states))
+            if tick_end - phase_start > self.looptime:
+                self._overrun_counter.inc()
 
             ####
 
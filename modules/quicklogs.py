@@ -1,12 +1,49 @@
 import datetime
+import threading
+import queue
+import atexit
+import time
 import os
 
+_stop = object() #queued by close to stop the writer
+
 class Log:
-    def __init__(self, address, clear = True):
+    """
+    Text log file. Entries are queued and written by a background thread in batches, so adding one doesn't touch the disk
+    
+    Entries below level are discarded before they are formatted. If the queue is full, entries are dropped (and counted) instead of blocking the caller. When the file grows past max_size bytes it is moved to address.1 (keeping up to backups old files) and a new one is started
+    
+    Call close when the log is no longer needed to stop the writer thread and close the file
+    """
+    levels = {'debug': 10,
+              'info': 20,
+              'warning': 30,
+              'error': 40}
+    
+    def __init__(self, address, clear = True, level = 'info', buffered = True, max_queue = 10000, flush_interval = 1, max_size = None, backups = 2):
         self.address = address
+        self.level = level
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.backups = backups
+        
+        self.dropped = 0 #number of entries that didn't fit in the queue since the last batch was written
+        self._queue = queue.Queue(maxsize = max_queue)
         
         if clear:
             self.clear()
+        
+        self._writer = None
+        if self.buffered:
+            self._writer = threading.Thread(target = self._writerd, name = 'Log writer daemon', daemon = True)
+            self._writer.start()
+            atexit.register(self.close)
+    
+    @classmethod
+    def from_config(cls, address, config):
+        'Make a log using the settings from a \'logs\' config category'
+        return cls(address, level = config.get('level', 'info'), max_size = config.get('max size', None), backups = config.get('backups', 2), flush_interval = config.get('flush interval', 1))
     
     def _write(self, text, newline = True):
         with open(self.address, 'w') as file:
@@ -28,9 +65,133 @@ class Log:
     def clear(self):
         self._write('Log {}:'.format(os.path.basename(self.address)), newline = False)
     
-    def add(self, category, message, console = False):
-        self._append('[{:^19}] [{:^20}]: {}'.format(self._getdatetime(), category, message), True, console)
+    def is_enabled(self, level):
+        'Whether entries of this level will be written. Check this before building an expensive message'
+        return self.levels[level] >= self.levels[self.level]
+    
+    def add(self, category, message, console = False, level = 'info'):
+        if not self.is_enabled(level):
+            return
+        
+        text = '[{:^19}] [{:^20}]: {}'.format(self._getdatetime(), category, message)
+        
+        if self.buffered:
+            try:
+                self._queue.put_nowait(text)
+            except queue.Full:
+                self.dropped += 1
+            
+            if console:
+                print(text)
+        
+        else:
+            self._rotate_if_needed()
+            self._append(text, True, console)
+    
+    def get_queue_depth(self):
+        'Number of entries waiting to be written'
+        return self._queue.qsize()
+    
+    def flush(self, timeout = 5):
+        'Wait until every queued entry has been written to the disk. Returns False if this took longer than timeout seconds'
+        if not self.buffered or not self._writer.is_alive():
+            return True
+        
+        flushed = threading.Event() #set by the writer once everything queued before it has been written
+        try:
+            self._queue.put(flushed, timeout = timeout)
+        except queue.Full:
+            return False
+        return flushed.wait(timeout)
+    
+    def close(self, timeout = 5):
+        'Write everything that is queued, stop the writer thread and close the file. Entries added afterwards are written directly'
+        if self.buffered:
+            self.buffered = False
+            atexit.unregister(self.close)
+            
+            try:
+                self._queue.put(_stop, timeout = timeout)
+            except queue.Full:
+                pass
+            self._writer.join(timeout)
+    
+    def _writerd(self):
+        file = None
+        next_flush = time.time() + self.flush_interval
+        running = True
+        
+        while running:
+            try:
+                items = [self._queue.get(timeout = max(0, next_flush - time.time()))]
+            except queue.Empty:
+                items = []
+            
+            #take everything else that is waiting
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            running = _stop not in items
+            flush_events = [item for item in items if type(item) == threading.Event]
+            lines = [item for item in items if type(item) == str]
+            
+            if self.dropped > 0:
+                lines.append('[{:^19}] [{:^20}]: {} entries dropped - the log queue was full or the file couldn\'t be written'.format(self._getdatetime(), 'log', self.dropped))
+                self.dropped = 0
+            
+            #if the writer stopped, flush and close would wait for it until they timed out and nothing else would be logged, so errors only lose this batch
+            try:
+                if file is None:
+                    file = open(self.address, 'a')
+                
+                if len(lines) > 0:
+                    if self.max_size is not None and file.tell() > self.max_size:
+                        file.close()
+                        file = None
+                        self._rotate()
+                        file = open(self.address, 'a')
+                    
+                    file.write(''.join(['\n{}'.format(line) for line in lines]))
+                
+                if len(flush_events) > 0 or not running or time.time() >= next_flush:
+                    file.flush()
+                    next_flush = time.time() + self.flush_interval
+            
+            except Exception as e:
+                print('Couldn\'t write to log {}: {}'.format(self.address, e))
+                self.dropped += len(lines)
+                next_flush = time.time() + self.flush_interval
+                
+                if file is not None:
+                    try:
+                        file.close()
+                    except Exception:
+                        pass
+                    file = None
+            
+            for event in flush_events:
+                event.set()
+        
+        if file is not None:
+            file.close()
+    
+    def _rotate_if_needed(self):
+        if self.max_size is not None and os.path.isfile(self.address) and os.path.getsize(self.address) > self.max_size:
+            self._rotate()
+    
+    def _rotate(self):
+        'Move the log to address.1 (and older logs up one number) and start a new one'
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.isfile('{}.{}'.format(self.address, i)):
+                os.replace('{}.{}'.format(self.address, i), '{}.{}'.format(self.address, i + 1))
+        
+        if self.backups > 0:
+            os.replace(self.address, '{}.1'.format(self.address))
+        self.clear()
     
     def _getdatetime(self):
         now = datetime.datetime.now()
-        return '{}:{}:{} {}/{}/{}'.format(now.hour, now.minute, now.second, now.day, now.month, now.year)
\ No newline at end of file
+        return '{}:{}:{} {}/{}/{}'.format(now.hour, now.minute, now.second, now.day, now.month, now.year)
@@ -0,0 +1,126 @@
+import itertools
+import threading
+import struct
+import json
+import time
+
+#every record is the same size so that the ring buffer can be indexed directly
+RECORD_SIZE = 32
+KIND_TICK = 0
+KIND_RECV = 1
+KIND_SEND = 2
+
+#kind, lobby, tick number, timestamp, item phase duration, push phase duration, number of items, number of clients
+_tick_struct = struct.Struct('<BxhIdffHH4x')
+#kind, lobby (-1 for the menu), client id, timestamp, bytes, command id
+_net_struct = struct.Struct('<BxhIdIH10x')
+
+_file_magic = b'SDTR'
+_file_header = struct.Struct('<4sHHII') #magic, version, record size, number of records, length of command table
+
+
+class TraceRecorder:
+    """
+    Records server ticks and network traffic as fixed size binary records in a ring buffer. Only the last capacity records are kept
+    
+    Records are written with struct.pack_into into a preallocated buffer, so recording one costs around a microsecond. Use dump to save the buffer and read_trace to load it again
+    """
+    def __init__(self, capacity = 65536, enabled = True):
+        self.capacity = capacity
+        self.enabled = enabled
+        
+        self._buffer = bytearray(self.capacity * RECORD_SIZE)
+        self._counter = itertools.count() #next() is atomic, so threads never get the same slot
+        self._num_recorded = 0
+        
+        self._commands = {} #(command, subcommand): id
+        self._command_names = []
+        self._commands_lock = threading.Lock()
+    
+    def tick(self, lobby, tick_num, item_time, push_time, num_items, num_clients):
+        'Record a lobby tick. Durations are in seconds'
+        if self.enabled:
+            index = next(self._counter)
+            _tick_struct.pack_into(self._buffer, (index % self.capacity) * RECORD_SIZE, KIND_TICK, lobby, tick_num, time.time(), item_time, push_time, min(num_items, 65535), min(num_clients, 65535))
+            self._num_recorded = index + 1
+    
+    def net(self, kind, lobby, client_id, num_bytes, command, subcommand = None):
+        'Record a request sent (KIND_SEND) or received (KIND_RECV) by a client'
+        if self.enabled:
+            if type(subcommand) is not str: #only strings are expected, and the key has to be hashable
+                subcommand = None
+            
+            key = (command, subcommand)
+            command_id = self._commands.get(key)
+            if command_id is None:
+                command_id = self._add_command(key)
+            
+            index = next(self._counter)
+            _net_struct.pack_into(self._buffer, (index % self.capacity) * RECORD_SIZE, kind, lobby, client_id, time.time(), num_bytes, command_id)
+            self._num_recorded = index + 1
+    
+    def _add_command(self, key):
+        with self._commands_lock:
+            if key not in self._commands:
+                self._command_names.append('{} {}'.format(*key) if key[1] is not None else str(key[0]))
+                self._commands[key] = len(self._command_names) - 1
+            return self._commands[key]
+    
+    def dump(self, path):
+        'Write the records in the buffer to a file, oldest first. Returns the number of records written'
+        buffer = bytes(self._buffer)
+        num_recorded = self._num_recorded
+        command_table = json.dumps(self._command_names).encode()
+        
+        if num_recorded <= self.capacity:
+            records = buffer[:num_recorded * RECORD_SIZE]
+        else:
+            split = (num_recorded % self.capacity) * RECORD_SIZE
+            records = buffer[split:] + buffer[:split]
+        
+        with open(path, 'wb') as file:
+            file.write(_file_header.pack(_file_magic, 1, RECORD_SIZE, len(records) // RECORD_SIZE, len(command_table)))
+            file.write(command_table)
+            file.write(records)
+        
+        return len(records) // RECORD_SIZE
+
+
+def read_trace(path):
+    'Load a trace written by TraceRecorder.dump. Returns a list of tick records and a list of network records, as dictionaries'
+    with open(path, 'rb') as file:
+        data = file.read()
+    
+    magic, version, record_size, num_records, table_length = _file_header.unpack_from(data, 0)
+    if magic != _file_magic:
+        raise ValueError('{} is not a trace file'.format(path))
+    
+    offset = _file_header.size
+    command_names = json.loads(data[offset:offset + table_length].decode())
+    offset += table_length
+    
+    ticks = []
+    net = []
+    for i in range(num_records):
+        record_offset = offset + (i * record_size)
+        
+        if data[record_offset] == KIND_TICK:
+            kind, lobby, tick_num, timestamp, item_time, push_time, num_items, num_clients = _tick_struct.unpack_from(data, record_offset)
+            ticks.append({'lobby': lobby,
+                          'tick': tick_num,
+                          'time': timestamp,
+                          'item time': item_time,
+                          'push time': push_time,
+                          'items': num_items,
+                          'clients': num_clients})
+        
+        else:
+            kind, lobby, client_id, timestamp, num_bytes, command_id = _net_struct.unpack_from(data, record_offset)
+            net.append({'direction': {KIND_RECV: 'in', KIND_SEND: 'out'}[kind],
+                        'lobby': lobby,
+                        'client': client_id,
+                        'time': timestamp,
+                        'bytes': num_bytes,
+                        'command': command_names[command_id]})
+    
+    return ticks, net
@@ -0,0 +1,84 @@
+import threading
+import sys
+
+class StreamCommandLine:
+    """
+    Console for a headless server, using stdin and stdout instead of a Tk window. Has the same interface as servercmds.ServerCommandLineUI
+    
+    Every console (the server and each lobby) shares the same streams. Commands go to the server console unless they start with @<number> (e.g. "@1 lby_list"). Type @list to see the consoles and their numbers
+    """
+    _consoles = []
+    _consoles_lock = threading.Lock()
+    _output_lock = threading.Lock()
+    _input_thread = None
+    
+    def __init__(self, command_handler, pipe, frame = None, default_title = 'Server Command Line'):
+        self.command_handler = command_handler
+        self.pipe = pipe
+        self.title = default_title
+        
+        self.quit = False
+        
+        with self._consoles_lock:
+            self._consoles.append(self)
+            self.index = len(self._consoles) - 1
+            
+            if StreamCommandLine._input_thread is None:
+                StreamCommandLine._input_thread = threading.Thread(target = _input_receiver, name = 'Stream command line input receiver', daemon = True)
+                StreamCommandLine._input_thread.start()
+        
+        threading.Thread(target = self._server_receiver, name = 'Stream command line server receiver', daemon = True).start()
+    
+    def _server_receiver(self):
+        while not self.quit:
+            try:
+                self.push(self.pipe.recv())
+            except EOFError:
+                self.quit = True
+    
+    def push(self, output):
+        'Write console output, which can be a string or a list of strings'
+        if type(output) == str:
+            output = [output]
+        
+        with self._output_lock:
+            for line in output:
+                for line0 in str(line).split('\n'):
+                    if not (line0.startswith('$$') and line0.endswith('$$') and len(line0) > 4): #console window operations don't mean anything here
+                        sys.stdout.write('[{}] {}\n'.format(self.index, line0))
+            sys.stdout.flush()
+    
+    def set_title(self, title):
+        self.title = title
+    
+    def run_command(self, command):
+        self.push(['] {}'.format(command)])
+        self.push(self.command_handler(command))
+
+
+def _input_receiver():
+    'Read commands from stdin and pass them to the right console. Quits the server when stdin closes'
+    consoles = StreamCommandLine._consoles
+    
+    for line in sys.stdin:
+        line = line.strip()
+        if line == '':
+            continue
+        
+        if line == '@list':
+            with StreamCommandLine._output_lock:
+                for console in consoles:
+                    sys.stdout.write('@{}: {}\n'.format(console.index, console.title))
+                sys.stdout.flush()
+        
+        elif line.startswith('@'):
+            target, command = (line[1:].split(' ', 1) + [''])[:2]
+            if target.isdigit() and int(target) < len(consoles):
+                consoles[int(target)].run_command(command)
+            else:
+                consoles[0].push('No console @{} - type @list to see them'.format(target))
+        
+        else:
+            consoles[0].run_command(line)
+    
+    consoles[0].run_command('sv_quit')
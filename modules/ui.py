@@ -9,6 +9,7 @@ import functools
 import typing
 
 import modules.modloader
+import modules.config
 
 class UI:
     def __init__(self, autostart = True):
@@ -53,8 +54,7 @@ class UI:
             fonts = {}
             reliefs = {}
             
-            with open(os.path.join(sys.path[0], 'user', 'config.json'), 'r') as file:
-                settingsdata = json.load(file)
+            settingsdata = modules.config.service.get('user')
                 
             for style_type in settingsdata['styling']:
                 fonts[style_type] = settingsdata['styling'][style_type]['fonts']
@@ -0,0 +1,54 @@
+import argparse
+
+import numpy as np
+
+import modules.servertrace
+
+def percentiles(values, scale = 1):
+    'Format the 50th, 90th and 99th percentiles and the maximum of a list of values'
+    values = np.array(values) * scale
+    return '{:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(*np.percentile(values, [50, 90, 99]), np.max(values))
+
+def summarise(path):
+    ticks, net = modules.servertrace.read_trace(path)
+    print('{}: {} tick record(s), {} network record(s)'.format(path, len(ticks), len(net)))
+    
+    if len(ticks) + len(net) > 0:
+        times = [record['time'] for record in ticks + net]
+        print('Covers {:.1f}s'.format(max(times) - min(times)))
+    
+    #ticks
+    for lobby in sorted(set([record['lobby'] for record in ticks])):
+        lobby_ticks = [record for record in ticks if record['lobby'] == lobby]
+        print('\nLobby {} - {} tick(s)'.format(lobby, len(lobby_ticks)))
+        print('{:<20}{:>9} {:>9} {:>9} {:>9}'.format('', 'p50', 'p90', 'p99', 'max'))
+        print('{:<20}{}'.format('items (ms)', percentiles([record['item time'] for record in lobby_ticks], 1000)))
+        print('{:<20}{}'.format('push (ms)', percentiles([record['push time'] for record in lobby_ticks], 1000)))
+        print('{:<20}{}'.format('total (ms)', percentiles([record['item time'] + record['push time'] for record in lobby_ticks], 1000)))
+        if len(lobby_ticks) > 1:
+            print('{:<20}{}'.format('interval (ms)', percentiles(np.diff([record['time'] for record in lobby_ticks]), 1000)))
+        print('{:<20}{}'.format('items', percentiles([record['items'] for record in lobby_ticks])))
+        print('{:<20}{}'.format('clients', percentiles([record['clients'] for record in lobby_ticks])))
+    
+    #network
+    if len(net) > 0:
+        print('\nTraffic per client')
+        print('{:<10}{:>12}{:>12}{:>12}{:>12}'.format('client', 'in (B)', 'out (B)', 'in (reqs)', 'out (reqs)'))
+        for client in sorted(set([record['client'] for record in net])):
+            client_in = [record['bytes'] for record in net if record['client'] == client and record['direction'] == 'in']
+            client_out = [record['bytes'] for record in net if record['client'] == client and record['direction'] == 'out']
+            print('{:<10}{:>12}{:>12}{:>12}{:>12}'.format(client, sum(client_in), sum(client_out), len(client_in), len(client_out)))
+        
+        print('\nRequest sizes by command (bytes)')
+        print('{:<40}{:>8} {:>9} {:>9} {:>9} {:>9}'.format('', 'count', 'p50', 'p90', 'p99', 'max'))
+        for direction in ['in', 'out']:
+            for command in sorted(set([record['command'] for record in net if record['direction'] == direction])):
+                sizes = [record['bytes'] for record in net if record['direction'] == direction and record['command'] == command]
+                print('{:<40}{:>8} {}'.format('{} {}'.format(direction, command)[:39], len(sizes), percentiles(sizes)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Summarise a trace saved with the server\'s sv_trace_dump command')
+    parser.add_argument('path', help = 'trace file to read')
+    args = parser.parse_args()
+    
+    summarise(args.path)
@@ -1,6 +1,5 @@
 from tkinter import messagebox
 import tkinter as tk
-import multiprocessing as mp
 import os
 import sys
 import math
@@ -11,7 +10,9 @@ import time
 import modules.colops
 import modules.editor
 import modules.bettercanvas
+import modules.config
 import modules.toolhelp
+import modules.ui
 
 class EditorLayout(modules.editor.EditorSnapin):
     """
@@ -910,6 +911,16 @@ class EditorLightMap(modules.editor.EditorSnapin):
         
         self.label_warning = tk.Label(self.frame, text = 'loading..', **self.ui_styling.get(font_size = 'medium', object_type = tk.Label))
         self.button_generate = tk.Button(self.frame, text = 'Generate', command = self.generate, **self.ui_styling.get(font_size = 'large', object_type = tk.Button))
+        self.renderer_flipswitch = modules.ui.TkFlipSwitch(self.frame, options = [{'text': 'Per cell (stock python)'}, {'text': 'Vectorised (requires numpy)'}], **self.ui_styling.get(font_size = 'medium', object_type = tk.Button))
+        
+        self.rebake_flipswitch = modules.ui.TkFlipSwitch(self.frame, options = [{'text': 'Update changed tiles'}, {'text': 'Rebuild everything'}], **self.ui_styling.get(font_size = 'medium', object_type = tk.Button))
+        
+        if self.user_config['editor']['lightmap'].get('renderer', 'cells') == 'numpy':
+            self.renderer_flipswitch.on_option_press(1, run_binds = False)
+        
+        self.preview_label = tk.Label(self.frame, **self.ui_styling.get(font_size = 'medium', object_type = tk.Label))
+        self.preview_image = None
+        self.preview_shown_at = 0
         
         self.log_frame = tk.Frame(self.frame)
         self.log_list = tk.Listbox(self.log_frame, **self.ui_styling.get(font_size = 'small', object_type = tk.Listbox))
@@ -920,11 +931,14 @@ class EditorLightMap(modules.editor.EditorSnapin):
         self.log_list.pack(side = tk.LEFT, fill = tk.BOTH, expand = True)
         
         self.label_warning.grid(row = 0, column = 0, sticky = 'NESW')
-        self.button_generate.grid(row = 1, column = 0, sticky = 'NESW')
-        self.log_frame.grid(row = 2, column = 0, sticky = 'NESW')
+        self.renderer_flipswitch.grid(row = 1, column = 0, sticky = 'NESW')
+        self.rebake_flipswitch.grid(row = 2, column = 0, sticky = 'NESW')
+        self.button_generate.grid(row = 3, column = 0, sticky = 'NESW')
+        self.log_frame.grid(row = 4, column = 0, sticky = 'NESW')
+        self.preview_label.grid(row = 0, column = 1, rowspan = 5, sticky = 'NESW')
         
-        self.ui_styling.set_weight(self.frame, 1, 3, dorows = False)
-        self.frame.rowconfigure(2, weight = 1)
+        self.ui_styling.set_weight(self.frame, 2, 5, dorows = False)
+        self.frame.rowconfigure(4, weight = 1)
         
         if self.user_config['graphics']['PILrender']:
             self.label_warning.config(text = 'PIL is enabled\nReady to generate light map')
@@ -955,18 +969,16 @@ class EditorLightMap(modules.editor.EditorSnapin):
         import modules.lightcalc #bad practice, but needed for pickling
         self.tabobj.set_title('Done')
         
-        self.log_list.insert(tk.END, 'Allocating calculation processes...')
-        
         with open(os.path.join(self.editorobj.map.path, 'list.json'), 'r') as file:
             mapcfg = json.load(file)
         
         self.log_list.insert(tk.END, 'Getting PIL Image object...')
         PILImage = __import__('PIL.Image').Image
+        self.PILImageTk = __import__('PIL.ImageTk').ImageTk
         self.log_list.insert(tk.END, 'Done')
         
         self.log_list.insert(tk.END, 'Making blank lightmap...')
         image = PILImage.new('RGBA', (mapcfg['geometry'][0], mapcfg['geometry'][1]), 'black')
-        pixels = image.load()
         self.log_list.insert(tk.END, 'Done')
         
         self.log_list.insert(tk.END, 'Loading map data...')
@@ -1000,49 +1012,60 @@ class EditorLightMap(modules.editor.EditorSnapin):
                 self.blocking_panels.append(panel)
         self.log_list.insert(tk.END, 'Done')
         
-        self.log_list.insert(tk.END, 'Allocating calculation processes...')
-        pipe, process_pipe = mp.Pipe()
-
-        #generate segments
-        j = 1
-        segments = []
-        seg_width = int(mapcfg['geometry'][0] / self.user_config['graphics']['lightcalc threads'])
-        for i in range(seg_width, mapcfg['geometry'][0] + seg_width, seg_width):
-            segments.append([j, i])
-            j = i
-        
-        #allocate segments to processes
-        for x0, x1 in segments:
-            self.log_list.insert(tk.END, 'Allocated segment x = {}-{}'.format(x0, x1))
-            mp.Process(target = modules.lightcalc.CalcSegment, args = [x0, x1, mapcfg['geometry'][1], process_pipe, self.map_data, self.materials, self.light_sources, self.blocking_panels, self.user_config['editor']['lightmap']['render shadows']]).start()
-        
-        self.log_list.insert(tk.END, 'Done')
+        lightmap_path = os.path.join(self.editorobj.map.path, 'models', 'system', 'lightmap', 'lightmap.png')
+        record_path = os.path.join(self.editorobj.map.path, 'models', 'system', 'lightmap', 'dependencies.json')
         
-        self.log_list.insert(tk.END, 'Generating lightmap...')
-        command = None
-        checked_in = 0
-        while not command == 'exit':
-            command = pipe.recv()
+        record = None
+        changed_tiles = None
+        base = None
+        if self.rebake_flipswitch.state == 0 and os.path.isfile(record_path) and os.path.isfile(lightmap_path):
+            self.log_list.insert(tk.END, 'Finding changed tiles...')
+            with open(record_path, 'r') as file:
+                record = json.load(file)
             
-            if command == 'done':
-                checked_in += 1
-                self.log_list.insert(tk.END, 'Segments complete: {}'.format(checked_in))
-                if checked_in >= 8:
-                    command = 'exit'
-            elif command[0] == 'message':
-                self.log_list.insert(tk.END, command[1])
-                self._see_bottom()
+            changed_tiles = modules.lightcalc.find_changed_tiles(record, self.map_data, self.materials, self.light_sources, self.blocking_panels, self.user_config['editor']['lightmap']['render shadows'])
+            
+            if changed_tiles is None:
+                record = None
+                self.log_list.insert(tk.END, 'Lighting settings or materials have changed, rebuilding everything')
             else:
-                to_write = (0, 0, 0, 255 - command[1])
-                if self.map_data['grid']['apply to lightmap']:
-                    for x in range(command[0][0], command[0][0] + self.map_data['grid']['mult']['x'], 1):
-                        for y in range(command[0][1], command[0][1] + self.map_data['grid']['mult']['y'], 1):
-                            try:
-                                pixels[x, y] = to_write
-                            except IndexError:
-                                pass
-                else:
-                    pixels[command[0][0], command[0][1]] = to_write
+                with PILImage.open(lightmap_path) as old_image:
+                    base = modules.lightcalc.rgba_to_values(old_image.convert('RGBA'))
+                self._show_preview(base)
+                self.log_list.insert(tk.END, 'Done - {} of {} tiles have changed'.format(len(changed_tiles), len(record['tiles'])))
+        
+        if base is None:
+            #show rough versions of the lightmap while the full version is calculated
+            preview_calc = modules.lightcalc.VectorCalc(self.map_data, self.materials, self.light_sources, self.blocking_panels, self.user_config['editor']['lightmap']['render shadows'])
+            for step in self.user_config['editor']['lightmap'].get('preview steps', [8, 4, 2]):
+                self.log_list.insert(tk.END, 'Making preview (every {} cells)...'.format(step))
+                self._see_bottom()
+                base = preview_calc.render_preview(mapcfg['geometry'][0], mapcfg['geometry'][1], step)
+                self._show_preview(base)
+                self.log_list.insert(tk.END, 'Done')
+        
+        self.log_list.insert(tk.END, 'Splitting lightmap into tiles...')
+        self.lightcalc = modules.lightcalc.TileScheduler(self.map_data, self.materials, self.light_sources, self.blocking_panels, self.user_config['editor']['lightmap']['render shadows'], self.user_config['graphics']['lightcalc threads'], ['cells', 'numpy'][self.renderer_flipswitch.state], self.user_config['editor']['lightmap'].get('tile size', 32), changed_tiles, self.user_config['editor']['lightmap'].get('shadow wedges', True))
+        self.log_list.insert(tk.END, 'Done - {} tiles across {} processes'.format(len(self.lightcalc.tiles), self.lightcalc.workers))
+        
+        self.button_generate.config(text = 'Cancel', command = self.cancel, state = tk.ACTIVE)
+        
+        self.log_list.insert(tk.END, 'Generating lightmap...')
+        self._see_bottom()
+        values = self.lightcalc.run(self._show_progress, base)
+        
+        self.button_generate.config(text = 'Generate', command = self.generate, state = tk.DISABLED)
+        
+        if values is None:
+            self.log_list.insert(tk.END, 'Lightmap generation was cancelled')
+            self.tabobj.set_title('ready')
+            self.button_generate.config(state = tk.ACTIVE)
+            self._see_bottom()
+            return
+        self.log_list.insert(tk.END, 'Done')
+        
+        self.log_list.insert(tk.END, 'Assembling lightmap...')
+        image.paste(PILImage.fromarray(modules.lightcalc.values_to_rgba(values), 'RGBA'))
         self.log_list.insert(tk.END, 'Done')
         
         self.map_data['lighting']['map'] = os.path.join('models', 'system', 'lightmap', 'lightmap.png')
@@ -1051,9 +1074,15 @@ class EditorLightMap(modules.editor.EditorSnapin):
         image.save(os.path.join(self.editorobj.map.path, self.map_data['lighting']['map']))
         self.log_list.insert(tk.END, 'Done')
         
+        self.log_list.insert(tk.END, 'Saving tile dependencies...')
+        with open(record_path, 'w') as file:
+            json.dump(self.lightcalc.get_record(record), file, sort_keys = True)
+        self.log_list.insert(tk.END, 'Done')
+        
         self.log_list.insert(tk.END, 'Saving config...')
         with open(os.path.join(self.editorobj.map.path, 'list.json'), 'w') as file:
             json.dump(self.map_data, file, sort_keys = True, indent = '\t')
+        modules.config.service.forget(os.path.join(self.editorobj.map.path, 'list.json'))
         self.log_list.insert(tk.END, 'Done')
         
         self.log_list.insert(tk.END, 'Lightmap is complete')
@@ -1064,6 +1093,30 @@ class EditorLightMap(modules.editor.EditorSnapin):
         
         self._see_bottom()
     
+    def cancel(self, event = None):
+        if self.lightcalc is not None:
+            self.lightcalc.cancel()
+            self.log_list.insert(tk.END, 'Cancelling...')
+            self._see_bottom()
+    
+    def _show_progress(self, tiles_done, tiles_total, eta):
+        percentage = int((tiles_done / tiles_total) * 100)
+        self.tabobj.set_title('generating... {}%'.format(percentage))
+        
+        if self.lightcalc.live_values is not None and (tiles_done == tiles_total or time.time() - self.preview_shown_at > 0.5): #full resolution tiles are drawn over the preview as they finish
+            self._show_preview(self.lightcalc.live_values)
+        
+        if tiles_done == tiles_total or int(((tiles_done - 1) / tiles_total) * 10) < int((tiles_done / tiles_total) * 10): #log every 10%
+            self.log_list.insert(tk.END, 'Tiles complete: {}/{} ({}s left)'.format(tiles_done, tiles_total, round(eta)))
+            self._see_bottom()
+    
+    def _show_preview(self, values):
+        image = __import__('PIL.Image').Image.fromarray(values, 'L')
+        image.thumbnail((512, 512))
+        
+        self.preview_image = self.PILImageTk.PhotoImage(image)
+        self.preview_label.config(image = self.preview_image)
+        self.preview_shown_at = time.time()
     
     def _see_bottom(self, event = None):
         self.log_list.see(tk.END)
@@ -8,6 +8,7 @@ import threading
 
 import modules.ui
 import modules.editor
+import modules.config
 
 class UIMenu(modules.ui.UIObject):
     def __init__(self, frame, ui):
@@ -214,6 +215,7 @@ class UIClientSettings(modules.ui.UIObject):
         
         with open(os.path.join(sys.path[0], 'user', 'config.json'), 'w') as file:
            json.dump(settingsdict, file, sort_keys=True, indent='\t')
+        modules.config.service.reload('user')
         
     def _choice_accept(self):
         self._write_settings()
@@ -341,6 +343,7 @@ class UIConnectToServer(modules.ui.UIObject):
         
         with open(os.path.join(sys.path[0], 'user', 'config.json'), 'w') as file:
             json.dump(settingsdata, file, sort_keys = True, indent = '\t')
+        modules.config.service.reload('user')
     
         self._populate_server_list()
         self._vars.address.set('')
@@ -568,6 +571,7 @@ class UIServerSettings(modules.ui.UIObject):
         
         with open(path, 'w') as file:
             json.dump(settingsdict, file, sort_keys=True, indent='\t')
+        modules.config.service.reload('server')
     
     def _choice_accept(self):
         self._push_settings(os.path.join(sys.path[0], 'server', 'config.json'))